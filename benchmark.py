@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tarfile
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from io import StringIO
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import faas
+
+
+def main():
+    vargs = init_args_parse()
+    return vargs.func(vargs)
+
+
+def init_args_parse():
+    parser = ArgumentParser(description='Benchmarks of the faas.py update steps...')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    extract = subparsers.add_parser('extract', help='Compare the extraction backends on a synthetic archive')
+    extract.add_argument('--size-mb', help='Uncompressed size of the archive (default: 256)', type=int, default=256)
+    extract.add_argument('--files', help='Number of files in the archive (default: 2000)', type=int, default=2000)
+    extract.add_argument('--workers', help='Writer threads of the python backend (default: 4)', type=int, default=4)
+    extract.set_defaults(func=benchmark_extract)
+
+    page = subparsers.add_parser('parser', help='Parse a large synthetic download page')
+    page.add_argument('--versions', help='Number of versions listed on the page (default: 5000)', type=int,
+                      default=5000)
+    page.add_argument('--repeat', help='Number of runs, the best one is kept (default: 5)', type=int, default=5)
+    page.set_defaults(func=benchmark_parser)
+
+    startup = subparsers.add_parser('startup', help='Check the import time of the CLI fast paths against a budget')
+    startup.add_argument('--repeat', help='Number of runs, the best one is kept (default: 10)', type=int, default=10)
+    startup.add_argument('--budget-help', help='Import budget of -h in ms (default: 40)', type=float, default=40)
+    startup.add_argument('--budget-version', help='Import budget of -i in ms (default: 40)', type=float, default=40)
+    startup.add_argument('--budget-update', help='Import budget of a no-op -u in ms (default: 40)', type=float,
+                         default=40)
+    startup.set_defaults(func=benchmark_startup)
+
+    update = subparsers.add_parser('update', help='Install, update and check a server from a local mirror')
+    update.add_argument('--size-mb', help='Uncompressed size of the archives (default: 64)', type=int, default=64)
+    update.add_argument('--files', help='Number of files in the archives (default: 500)', type=int, default=500)
+    update.add_argument('-o', '--option', help='Option of the [DEFAULT] section of the config, like download-mode=file'
+                        ' (can be repeated)', action='append', default=[])
+    update.add_argument('--output', help='Write the results in this JSON file, to be used as a baseline later')
+    update.add_argument('--baseline', help='Compare the results with a JSON file written by --output')
+    update.add_argument('-v', '--verbose', help='Show the output of faas.py', action='store_true')
+    update.set_defaults(func=benchmark_update)
+    return parser.parse_args()
+
+
+def create_synthetic_archive(directory, size_mb, files, version=None):
+    """
+    Create a factorio-like tar.xz: half of the files are random (like the graphics),
+    the other half are very compressible (like the lua/json data).
+    With a version, the archive also contains a fake binary answering --version.
+    """
+    root = os.path.join(directory, 'factorio')
+    if version:
+        binary = os.path.join(root, 'bin', 'x64', 'factorio')
+        os.makedirs(os.path.dirname(binary))
+        with open(binary, 'w') as f:
+            f.write('#!/bin/sh\necho "Version: {0} (build 1, linux64, headless)"\n'.format(version))
+        os.chmod(binary, 0o755)
+    size = size_mb * 1024 * 1024 // max(1, files)
+    for i in range(files):
+        path = os.path.join(root, 'data', 'mod{0}'.format(i % 20), 'file{0}.dat'.format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if i % 2:
+                f.write(os.urandom(size))
+            else:
+                f.write(('{0} local data = {{}}\n'.format(i) * (size // 24 + 1)).encode()[:size])
+    archive = os.path.join(directory, 'factorio_headless.tar.xz')
+    if shutil.which('xz'):
+        # Multi-threaded compression creates several blocks, so the archive can be decompressed in parallel
+        tar = os.path.join(directory, 'factorio_headless.tar')
+        subprocess.check_call(['tar', '-cf', tar, '-C', directory, 'factorio'])
+        subprocess.check_call(['xz', '-T0', '-1', tar])
+    else:
+        with tarfile.open(archive, 'w:xz', preset=1) as tar:
+            tar.add(root, arcname='factorio')
+    shutil.rmtree(root)
+    return archive
+
+
+def benchmark_extract(vargs):
+    with tempfile.TemporaryDirectory(prefix='faas-bench-') as directory:
+        print('Creating a synthetic archive ({0} MB, {1} files)...'.format(vargs.size_mb, vargs.files))
+        archive = create_synthetic_archive(directory, vargs.size_mb, vargs.files)
+        print('Archive size: {0}'.format(faas.format_size(os.path.getsize(archive))))
+        plain_tar = faas.TarExtractor(vprint=lambda *args, **kwargs: None)
+        plain_tar.decompressor = None
+        backends = [plain_tar,
+                    faas.TarExtractor(vprint=lambda *args, **kwargs: None),
+                    faas.PythonExtractor(1, vprint=lambda *args, **kwargs: None),
+                    faas.PythonExtractor(vargs.workers, vprint=lambda *args, **kwargs: None)]
+        rows = [('Backend', 'File', 'Stream')]
+        for backend in backends:
+            times = []
+            for streamed in (False, True):
+                destination = tempfile.mkdtemp(dir=directory)
+                start = time.time()
+                if streamed:
+                    with open(archive, 'rb') as f:
+                        backend.extract(f, destination)
+                else:
+                    backend.extract_file(archive, destination)
+                times.append('{0:.2f}s'.format(time.time() - start))
+                shutil.rmtree(destination)
+            rows.append((str(backend),) + tuple(times))
+        print_table(rows)
+
+
+class LegacyPageParser(faas.FactorioVersionPageParser):
+    """Previous behaviour of the parser: the whole list was sorted again after each download link"""
+
+    def add_version(self, version):
+        super().add_version(version)
+        self._versions.sort(key=lambda x: x.number, reverse=True)
+
+
+def create_synthetic_page(versions):
+    """Download page with the most recent version first, like factorio.com"""
+    ls = ['<html><body><div class="filler">{0}</div>'.format('lorem ipsum ' * 50)]
+    for i in range(versions, 0, -1):
+        version = '{0}.{1}.{2}'.format(i // 10000, (i // 100) % 100, i % 100)
+        ls.append('<h3>{0} (stable)</h3><p>{1}</p><a href="/get-download/{0}/headless/linux64">Download</a>'
+                  .format(version, 'Release notes ' * 10))
+    ls.append('</body></html>')
+    return ''.join(ls)
+
+
+def feed_page(parser, page):
+    for i in range(0, len(page), faas.PAGE_CHUNK_SIZE):
+        parser.feed(page[i:i + faas.PAGE_CHUNK_SIZE])
+        if parser.done:
+            break
+    return parser
+
+
+def benchmark_parser(vargs):
+    page = create_synthetic_page(vargs.versions)
+    print('Synthetic page: {0} versions, {1}'.format(vargs.versions, faas.format_size(len(page))))
+    cases = [('legacy (sort after each link)', lambda: LegacyPageParser()),
+             ('full list (sorted once)', lambda: faas.FactorioVersionPageParser()),
+             ('latest only (early exit)', lambda: faas.FactorioVersionPageParser(latest_only=True))]
+    rows = [('Parser', 'Best time', 'Latest version')]
+    for label, factory in cases:
+        best, parser = None, None
+        for _ in range(vargs.repeat):
+            start = time.time()
+            parser = feed_page(factory(), page)
+            _ = parser.available_version
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rows.append((label, '{0:.4f}s'.format(best), parser.latest_version.number.vstring))
+    start = time.time()
+    for _ in range(vargs.versions):
+        faas.str_to_version('Version: 1.1.104 (build 12345, linux64, headless)')
+    rows.append(('str_to_version x{0}'.format(vargs.versions), '{0:.4f}s'.format(time.time() - start), '-'))
+    print_table(rows)
+
+
+# Modules that are only needed to download, extract or run the daemon, the fast paths must not load them
+HEAVY_MODULES = ('urllib.request', 'http.client', 'ssl', 'html.parser', 'asyncio', 'tarfile', 'hashlib',
+                 'subprocess', 'concurrent.futures')
+
+
+def create_startup_config(directory, experimental=False):
+    """Installed server with a fake binary and a fresh page cache, so that -u has nothing to do offline"""
+    install = os.path.join(directory, 'factorio')
+    binary = os.path.join(install, 'bin', 'x64', 'factorio')
+    if not os.path.exists(binary):
+        os.makedirs(os.path.dirname(binary))
+        with open(binary, 'w') as f:
+            f.write('#!/bin/sh\necho "Version: 1.1.100 (build 1, linux64, headless)"\n')
+        os.chmod(binary, 0o755)
+    page = {'etag': None, 'last-modified': None, 'fetched': time.time() + 3600,
+            'versions': [['1.1.100', '/get-download/1.1.100/headless/linux64']], 'complete': True}
+    urls = ['http://127.0.0.1:9/download-headless', 'http://127.0.0.1:9/download-headless/experimental']
+    with open(os.path.join(directory, 'faas_cache.json'), 'w') as f:
+        json.dump({'pages': {url: page for url in urls}}, f)
+    config = os.path.join(directory, 'config-experimental.ini' if experimental else 'config.ini')
+    with open(config, 'w') as f:
+        f.write('[DEFAULT]\nfactorio-path={0}\nsave-path={1}\nuser=root\nexperimental={2}\n'
+                '[WEBSITE]\nbaseurl=http://127.0.0.1:9\nstablepage=/download-headless\n'
+                'experimentalpage=/download-headless/experimental\n'
+                '[CACHE]\npage-cache-ttl=3600\n'.format(install, os.path.join(directory, 'save.zip'),
+                                                        'yes' if experimental else 'no'))
+    return config
+
+
+def startup_cases(directory, budget_help=40, budget_version=40, budget_update=40):
+    """(label, arguments of faas.py, import budget in ms) of the fast paths"""
+    config = create_startup_config(directory)
+    experimental = create_startup_config(directory, experimental=True)
+    return [('-h', ['-h'], budget_help),
+            ('-i', ['-C', config, '-i'], budget_version),
+            ('-u (up-to-date)', ['-C', config, '-u'], budget_update),
+            ('-u (experimental)', ['-C', experimental, '-u'], budget_update)]
+
+
+def measure_startup(args, repeat):
+    """Best run (wall time, import time, modules) of a fast path, after a first run filling the local caches"""
+    # The first run fills the local version cache, like the first call of a monitoring probe
+    measure_imports(args)
+    runs = [measure_imports(args) for _ in range(repeat)]
+    return min(runs, key=lambda x: x[1])
+
+
+def measure_imports(args):
+    """Returns the wall time, the import time of faas.py and the modules it loaded, from -X importtime"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'faas.py')
+    with tempfile.TemporaryDirectory() as empty:
+        # Interpreter start-up imports (site, encodings...) are the same for any script, they are not counted
+        baseline = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'], cwd=empty,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    skipped = set(re.findall(r'\|\s*(\S+)$', baseline.stderr, re.M))
+    start = time.time()
+    sub = subprocess.run([sys.executable, '-X', 'importtime', script] + args,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.time() - start
+    total, modules = 0, set()
+    for line in sub.stderr.splitlines():
+        res = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$', line)
+        if not res or res.group(3) in skipped:
+            continue
+        modules.add(res.group(3))
+        if not res.group(2):
+            total += int(res.group(1))
+    if sub.returncode != 0:
+        raise RuntimeError('faas.py {0} failed:\n{1}'.format(' '.join(args), sub.stderr[-2000:]))
+    return wall, total / 1000000, modules
+
+
+def benchmark_startup(vargs):
+    with tempfile.TemporaryDirectory(prefix='faas-bench-') as directory:
+        cases = startup_cases(directory, vargs.budget_help, vargs.budget_version, vargs.budget_update)
+        rows = [('Command', 'Wall time', 'Imports', 'Budget', 'Heavy modules')]
+        failed = False
+        for label, args, budget in cases:
+            wall, imports, modules = measure_startup(args, vargs.repeat)
+            heavy = [name for name in HEAVY_MODULES if name in modules]
+            over = imports * 1000 > budget or heavy
+            failed = failed or over
+            rows.append((label, '{0:.1f}ms'.format(wall * 1000), '{0:.1f}ms'.format(imports * 1000),
+                         '{0:.0f}ms{1}'.format(budget, ' EXCEEDED' if over else ''), ', '.join(heavy) or '-'))
+        print_table(rows)
+    return 1 if failed else 0
+
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    """Static files, with the single Range requests used by the segmented downloads"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        res = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not res or not os.path.isfile(path):
+            return super().do_GET()
+        size = os.path.getsize(path)
+        start, end = int(res.group(1)), min(int(res.group(2) or size - 1), size - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = f.read(min(remaining, faas.DOWNLOAD_CHUNK_SIZE))
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+def start_mirror(directory):
+    """Local stand-in for factorio.com, serving directory in a thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: MirrorHandler(*args, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def publish_version(www, version, stamp):
+    """
+    Download pages listing version as the latest release. stamp must increase with each call: the Last-Modified
+    of the mirror has a one second resolution, the update would get a 304 for a page rewritten in the same second
+    """
+    for page in ('download-headless', os.path.join('download-headless', 'experimental')):
+        os.makedirs(os.path.join(www, page), exist_ok=True)
+        with open(os.path.join(www, page, 'index.html'), 'w') as f:
+            f.write('<html><body><h3>{0} (stable)</h3><a href="/get/factorio_headless_x64_{0}.tar.xz">Download</a>'
+                    '<h3>0.1.0</h3><a href="/get/old.tar.xz">Download</a></body></html>'.format(version))
+        os.utime(os.path.join(www, page, 'index.html'), (stamp, stamp))
+
+
+def read_written_bytes():
+    """
+    Bytes written to files by this process and its finished children (write_bytes of /proc/self/io):
+    unlike wchar, the data sent to the tar/xz pipes is not counted
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def read_peak_rss():
+    """Peak RSS of this process in bytes since the last reset_peak_rss (VmHWM of /proc/self/status)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss():
+    """Restart the peak RSS from the current RSS (Linux >= 4.0), otherwise it stays the peak of the process"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def run_scenario(config, action, verbose, queue):
+    """Runs in a fresh process so that its peak RSS only covers the scenario"""
+    written, peaks, running = {}, {}, []
+    original = faas.UpdateMetrics.phase
+
+    @contextmanager
+    def phase(metrics, name):
+        before = read_written_bytes()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # The peak is reset for this phase: the phases around it keep the peak reached so far
+        running[:] = [max(peak, read_peak_rss()) for peak in running]
+        reset_peak_rss()
+        running.append(0)
+        with original(metrics, name):
+            yield
+        peak = max(running.pop(), read_peak_rss())
+        # Only the children that ended during the phase (tar, xz...) can raise their peak
+        after = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if after > children:
+            peak = max(peak, after * 1024)
+        running[:] = [max(outer, peak) for outer in running]
+        peaks[name] = max(peaks.get(name, 0), peak)
+        written[name] = written.get(name, 0) + read_written_bytes() - before
+
+    faas.UpdateMetrics.phase = phase
+    sys.argv = ['faas.py', '-C', config, '-u']
+    output = StringIO()
+    written_before = read_written_bytes()
+    start = time.time()
+    try:
+        with redirect_stdout(sys.stdout if verbose else output), redirect_stderr(sys.stderr if verbose else output):
+            fc = faas.FactorioCommands(faas.init_args_parse())
+            if action == 'check':
+                fc.is_download_needed()
+            else:
+                fc.update_server()
+    except SystemExit as err:
+        queue.put({'failed': err.code, 'output': output.getvalue()[-2000:]})
+        return
+    phases = dict(fc.metrics.phases, total=time.time() - start)
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    written['total'] = read_written_bytes() - written_before
+    peaks['total'] = peak * 1024
+    queue.put({'phases': phases, 'written': written, 'peak_rss': peak * 1024, 'peak_rss_phases': peaks,
+               'downloaded': fc.metrics.download_bytes})
+
+
+def wait_scenario(process, queue):
+    """Result of a scenario, or a failure when its process ended without one (crash, kill...)"""
+    from queue import Empty
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                break
+    try:
+        # Sent just before the end of the process
+        return queue.get(timeout=1)
+    except Empty:
+        return {'failed': process.exitcode, 'output': ''}
+
+
+def benchmark_update(vargs):
+    scenarios = [('install', '1.0.0', 'update'), ('update', '1.0.1', 'update'), ('check', '1.0.1', 'check')]
+    baseline = {}
+    if vargs.baseline:
+        with open(vargs.baseline) as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory(prefix='faas-bench-') as directory:
+        www = os.path.join(directory, 'www')
+        os.makedirs(os.path.join(www, 'get'))
+        print('Creating the synthetic archives ({0} MB, {1} files)...'.format(vargs.size_mb, vargs.files))
+        for version in sorted(set(scenario[1] for scenario in scenarios)):
+            archive = create_synthetic_archive(directory, vargs.size_mb, vargs.files, version)
+            os.rename(archive, os.path.join(www, 'get', 'factorio_headless_x64_{0}.tar.xz'.format(version)))
+        server, url = start_mirror(www)
+        config = os.path.join(directory, 'config.ini')
+        with open(config, 'w') as f:
+            f.write('[DEFAULT]\nfactorio-path={0}\nsave-path={1}\nuser=root\n{2}\n'
+                    '[WEBSITE]\nbaseurl={3}\nsha256page=\n[CACHE]\ncache-file={4}\n'
+                    .format(os.path.join(directory, 'factorio'), os.path.join(directory, 'save.zip'),
+                            '\n'.join(vargs.option), url, os.path.join(directory, 'faas_cache.json')))
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        try:
+            for i, (label, version, action) in enumerate(scenarios):
+                publish_version(www, version, time.time() + i)
+                queue = context.Queue()
+                process = context.Process(target=run_scenario, args=(config, action, vargs.verbose, queue))
+                process.start()
+                results[label] = wait_scenario(process, queue)
+                process.join()
+                if 'failed' in results[label]:
+                    # The next scenarios depend on this one
+                    print('Scenario {0} failed (exit code {1}):\n{2}'.format(label, results[label]['failed'],
+                                                                             results[label]['output']),
+                          file=sys.stderr)
+                    break
+        finally:
+            server.shutdown()
+    rows = [('Scenario', 'Phase', 'Time', 'Written', 'Peak RSS', 'Baseline')]
+    for label, _, _ in scenarios:
+        result = results.get(label)
+        if result is None or 'failed' in result:
+            rows.append((label, 'total', 'FAILED' if result else 'skipped', '', '', ''))
+            continue
+        for name in faas.UpdateMetrics.PHASES:
+            if name not in result['phases']:
+                continue
+            reference = baseline.get(label, {}).get('phases', {}).get(name)
+            rows.append((label, name, '{0:.3f}s'.format(result['phases'][name]),
+                         faas.format_size(result['written'].get(name, 0)),
+                         faas.format_size(result['peak_rss_phases'].get(name, 0)),
+                         'x{0:.2f}'.format(result['phases'][name] / reference) if reference else '-'))
+    print_table(rows)
+    if vargs.output:
+        with open(vargs.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any('failed' in result for result in results.values()) else 0
+
+
+def print_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,31 +2,104 @@
 import re
 import os
 import sys
-import subprocess
-from urllib.request import urlopen
-from urllib.error import HTTPError
+import json
+import time
+import threading
+from contextlib import contextmanager
 from argparse import ArgumentParser
-from html.parser import HTMLParser
 from collections import namedtuple
-from distutils.version import LooseVersion
 from configparser import ConfigParser
 
 
 SYSTEMD_PATH = '/etc/systemd/system'
 SUDOER_PATH = '/etc/sudoers.d'
+RUNTIME_PATH = '/run'
+TMP_PATH = '/tmp'
+LOCK_PATH = '/run/lock'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PAGE_CHUNK_SIZE = 16 * 1024
+DOWNLOAD_MODES = ('stream', 'file')
+INSTALL_MODES = ('inplace', 'staged')
+EXTRACT_BACKENDS = ('auto', 'tar', 'python')
+EXTRACT_MAX_PENDING = 64 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_STATE_INTERVAL = 8 * 1024 * 1024
+INCREMENTAL_SPOOL_SIZE = 16 * 1024 * 1024
+SERVER_SECTION_PREFIX = 'server:'
+VERSION_RE = re.compile(r'\d+(\.\d+)+')
+HTTP_TIMEOUT = 30
+HTTP_MAX_REDIRECTS = 5
+READY_MODES = ('no', 'log', 'journal', 'port')
+# Logged once the map is loaded and the server accepts players
+READY_RE = re.compile(r'Hosting game at IP ADDR|changing state from\(CreatingGame\) to\(InGame\)')
+READY_POLL_INTERVAL = 0.5
+CPU_SCHEDULING_POLICIES = ('other', 'batch', 'idle', 'fifo', 'rr')
+IO_SCHEDULING_CLASSES = ('realtime', 'best-effort', 'idle')
+TRANSPARENT_HUGEPAGES = ('always', 'madvise', 'never')
+THP_PATH = '/sys/kernel/mm/transparent_hugepage/enabled'
+# Saves are zip files: cutting the snapshots around the local file headers keeps the unchanged entries in
+# identical chunks from one save to the next
+SNAPSHOT_ANCHOR = b'PK\x03\x04'
+SNAPSHOT_MIN_CHUNK = 64 * 1024
+SNAPSHOT_MAX_CHUNK = 4 * 1024 * 1024
+# Smaller chunks (the zip headers) are kept in the manifest instead of the chunk store
+SNAPSHOT_INLINE_CHUNK = 512
+# A save written during its snapshot (autosave) is snapshotted again after a pause, then skipped
+SNAPSHOT_RETRIES = 3
+SNAPSHOT_RETRY_DELAY = 2
+# Mods shipped with the game, they are not on the mod portal
+BUILTIN_MODS = ('base', 'core', 'elevated-rails', 'quality', 'space-age')
+# Top-level entries extracted from the game archive, recorded in each versioned directory of install-mode=staged:
+# everything else (config, saves, mods...) is user data, copied from one version to the other
+SHIPPED_FILE = '.faas-shipped.json'
+SHIPPED_DEFAULT = ('bin', 'data', 'config-path.cfg')
 
 
 def main():
     vargs = init_args_parse()
     fc = FactorioCommands(vargs)
+    if vargs.server:
+        fc = fc.for_server(vargs.server)
     if vargs.latest_version:
         fc.get_latest_version()
     elif vargs.update:
-        fc.update_server()
+        if fc.config.server or not fc.config.servers:
+            fc.update_server()
+        else:
+            fc.update_fleet()
     elif vargs.installed_version:
-        fc.get_local_version()
+        for instance in fc.instances():
+            instance.get_local_version()
     elif vargs.create_service:
-        fc.create_service()
+        for instance in fc.instances():
+            instance.create_service()
+    elif vargs.cache_stats:
+        fc.get_cache_stats()
+    elif vargs.daemon:
+        UpdateDaemon(vargs, fc).run()
+    elif vargs.rollback:
+        instances = fc.instances()
+        if len(instances) > 1:
+            print('Several servers are configured, select the one to roll back with -s', file=sys.stderr)
+            sys.exit(-33)
+        instances[0].rollback_server()
+    elif vargs.snapshot:
+        for instance in fc.instances():
+            instance.snapshot_save()
+    elif vargs.snapshots:
+        fc.list_snapshots()
+    elif vargs.sync_mods:
+        for instance in fc.instances():
+            instance.sync_mods()
+    elif vargs.restore:
+        instances = fc.instances()
+        if len(instances) > 1:
+            print('Several servers are configured, select the one to restore with -s', file=sys.stderr)
+            sys.exit(-33)
+        instances[0].restore_snapshot(vargs.restore)
+    elif vargs.sync_saves:
+        for instance in fc.instances():
+            instance.sync_saves()
 
 
 def init_args_parse():
@@ -38,16 +111,34 @@ def init_args_parse():
     group.add_argument('-i', '--installed-version', help='Get the version of factorio installed on this server',
                        action='store_true')
     group.add_argument('-l', '--latest-version', help='Get the latest version of factorio', action='store_true')
+    group.add_argument('--cache-stats', help='Show the statistics of the shared archive cache', action='store_true')
+    group.add_argument('-d', '--daemon', help='Keep running and update the server(s) when a new version is released',
+                       action='store_true')
+    group.add_argument('-r', '--rollback', help='Switch back to the previous installed version (install-mode=staged)',
+                       action='store_true')
+    group.add_argument('--snapshot', help='Take a snapshot of the save file now', action='store_true')
+    group.add_argument('--snapshots', help='List the snapshots of the save files', action='store_true')
+    group.add_argument('--sync-mods', help='Update the mods of the server(s) for the installed version',
+                       action='store_true')
+    group.add_argument('--restore', help='Restore a snapshot of the save file ("latest" for the most recent one)',
+                       metavar='SNAPSHOT')
+    group.add_argument('--sync-saves', help='Copy the saves kept in memory to the disk (ram-saves)',
+                       action='store_true')
     parser.add_argument('-x', '--experimental', help='Force using the experimental version', action='store_true')
     parser.add_argument('-C', '--config-file', help='Config file path', default='/etc/faas/config.ini')
+    parser.add_argument('-s', '--server', help='Only manage the server configured in the [server:SERVER] section')
+    parser.add_argument('--dry-run', help='With -c, print the systemd units instead of installing them',
+                        action='store_true')
     parser.add_argument('-v', '--verbose', help='Verbose', action='store_true')
     return parser.parse_args()
 
 
 class ConfigData:
-    def __init__(self, config, command_args):
+    def __init__(self, config, command_args, config_path=None, server=None):
         self.config = config
         self.command_args = command_args
+        self.config_path = config_path
+        self.server = server
         self._verbose = None
         self._baseurl = None
         self._experimental = None
@@ -59,11 +150,86 @@ class ConfigData:
         self._factorio_service_path = None
         self._save_path = None
         self._user = None
+        self._download_mode = None
+        self._download_segments = None
+        self._sha256_url = None
+        self._page_timeout = None
+        self._cache_path = None
+        self._page_cache_ttl = None
+        self._install_mode = None
+        self._versions_dir = None
+        self._keep_versions = None
+        self._incremental_update = None
+        self._shared_cache_path = None
+        self._extract_backend = None
+        self._metrics_file = None
+        self._prometheus_path = None
+        self._wait_ready = None
+        self._ready_log = None
+        self._service_tuning = None
+        self._snapshot_path = None
+        self._mods_path = None
+        self._mods_cache_path = None
 
     def vprint(self, *args, **kwargs):
         if self.verbose:
+            if self.server:
+                args = ('[{0}]'.format(self.server),) + args
             print(*args, **kwargs)
 
+    def _section(self, section, option):
+        """
+        A [server:<name>] section overrides the DEFAULT and SERVICE options of its server. The SERVICE options it
+        does not set are read from [SERVICE], except service-name which must be different for each server.
+        """
+        if not self.server or section not in ('DEFAULT', 'SERVICE'):
+            return section
+        server_section = '{0}{1}'.format(SERVER_SECTION_PREFIX, self.server)
+        if section == 'SERVICE' and option != 'service-name' and not self._sets(server_section, option):
+            return section
+        return server_section
+
+    def _sets(self, section, option):
+        """True when the option is set in the section itself, not only inherited from [DEFAULT]"""
+        if not self.config.has_option(section, option):
+            return False
+        defaults = self.config.defaults()
+        return option not in defaults or self.config.get(section, option, raw=True) != defaults[option]
+
+    def get(self, section, option, **kwargs):
+        return self.config.get(self._section(section, option), option, **kwargs)
+
+    def getint(self, section, option, **kwargs):
+        return self.config.getint(self._section(section, option), option, **kwargs)
+
+    def getboolean(self, section, option, **kwargs):
+        return self.config.getboolean(self._section(section, option), option, **kwargs)
+
+    @property
+    def servers(self):
+        return [name[len(SERVER_SECTION_PREFIX):] for name in self.config.sections()
+                if name.startswith(SERVER_SECTION_PREFIX)]
+
+    @property
+    def poll_interval(self):
+        return max(10, self.config.getint('DAEMON', 'poll-interval', fallback=600))
+
+    @property
+    def poll_jitter(self):
+        return max(0, self.config.getint('DAEMON', 'poll-jitter', fallback=60))
+
+    @property
+    def updater_service_path(self):
+        name = self.config.get('DAEMON', 'service-name', fallback='faas-updater.service')
+        if not name.endswith('.service'):
+            print('Your updater service name must end with: ".service"', file=sys.stderr)
+            sys.exit(-100)
+        return os.path.join(SYSTEMD_PATH, name)
+
+    @property
+    def fleet_workers(self):
+        return max(1, self.config.getint('FLEET', 'workers', fallback=4))
+
     @property
     def verbose(self):
         if self._verbose is None:
@@ -74,7 +240,7 @@ class ConfigData:
     @property
     def experimental(self):
         if self._experimental is None:
-            self._experimental = self.config.getboolean('DEFAULT', 'experimental', fallback=False)
+            self._experimental = self.getboolean('DEFAULT', 'experimental', fallback=False)
             self._experimental = self._experimental or self.command_args.experimental
             if self.experimental:
                 self.vprint("Looking for Experimental version")
@@ -107,28 +273,132 @@ class ConfigData:
     @property
     def factorio_path(self):
         if self._factorio_path is None:
-            path = self.config.get('DEFAULT', 'factorio-path', fallback='/factorio')
+            path = self.get('DEFAULT', 'factorio-path', fallback='/factorio')
             self._factorio_path = get_abs_path(path)
         return self._factorio_path
 
+    @property
+    def install_name(self):
+        """factorio-path as a file name, for the lock and the temporary files of this installation"""
+        return 'faas{0}'.format(re.sub(r'\W', '_', self.factorio_path))
+
+    @property
+    def update_lock_path(self):
+        # /run/lock is only writable by root on some distributions (0755)
+        directory = LOCK_PATH if os.path.isdir(LOCK_PATH) and os.access(LOCK_PATH, os.W_OK) else TMP_PATH
+        return os.path.join(directory, '{0}.lock'.format(self.install_name))
+
+    @property
+    def archive_tmp_path(self):
+        return os.path.join(TMP_PATH, '{0}.tar.xz'.format(self.install_name))
+
     @property
     def factorio_binary(self):
         if self._factorio_binary is None:
             self._factorio_binary = os.path.join(self.factorio_path,
-                                                 self.config.get('DEFAULT', 'bin-path', fallback='bin/x64/factorio'))
+                                                 self.get('DEFAULT', 'bin-path', fallback='bin/x64/factorio'))
             self.vprint('Checking factorio binary at', self._factorio_binary)
         return self._factorio_binary
 
     @property
     def factorio_service(self):
         if self._factorio_service is None:
-            self._factorio_service = self.config.get('SERVICE', 'service-name', fallback='factorio.service')
+            default = 'factorio-{0}.service'.format(self.server) if self.server else 'factorio.service'
+            self._factorio_service = self.get('SERVICE', 'service-name', fallback=default)
             self.vprint("Service name found:", self._factorio_service)
             if not str(self._factorio_service).endswith('.service'):
                 print('Your service name must end with: ".service"', file=sys.stderr)
                 sys.exit(-100)
         return self._factorio_service
 
+    @property
+    def service_tuning(self):
+        """[Service] directives of the performance options, validated against the resources of this host"""
+        if self._service_tuning is None:
+            self._service_tuning = self._read_service_tuning()
+        return self._service_tuning
+
+    def _read_service_tuning(self):
+        tuning = []
+
+        def option(name):
+            # raw: memory limits can be percentages
+            return self.get('SERVICE', name, fallback='', raw=True).strip()
+
+        value = option('cpu-affinity')
+        if value:
+            cpus = parse_cpu_list(value)
+            if cpus is None:
+                invalid_option('cpu-affinity', value, 'expected a list of cpus like "0-3" or "0,2,4"')
+            if cpus[-1] >= (os.cpu_count() or 1):
+                invalid_option('cpu-affinity', value, 'this host only has {0} cpus'.format(os.cpu_count()))
+            tuning.append(('CPUAffinity', ' '.join(str(cpu) for cpu in cpus)))
+        value = option('nice')
+        if value:
+            if not re.match(r'^-?\d+$', value) or not -20 <= int(value) <= 19:
+                invalid_option('nice', value, 'expected a number between -20 and 19')
+            tuning.append(('Nice', value))
+        value = option('cpu-scheduling-policy').lower()
+        if value:
+            if value not in CPU_SCHEDULING_POLICIES:
+                invalid_option('cpu-scheduling-policy', value,
+                               'expected one of: {0}'.format(', '.join(CPU_SCHEDULING_POLICIES)))
+            tuning.append(('CPUSchedulingPolicy', value))
+        value = option('cpu-scheduling-priority')
+        if value:
+            if not value.isdigit() or not 1 <= int(value) <= 99:
+                invalid_option('cpu-scheduling-priority', value, 'expected a number between 1 and 99')
+            tuning.append(('CPUSchedulingPriority', value))
+        value = option('io-scheduling-class').lower()
+        if value:
+            if value not in IO_SCHEDULING_CLASSES:
+                invalid_option('io-scheduling-class', value,
+                               'expected one of: {0}'.format(', '.join(IO_SCHEDULING_CLASSES)))
+            tuning.append(('IOSchedulingClass', value))
+        value = option('io-scheduling-priority')
+        if value:
+            if not value.isdigit() or int(value) > 7:
+                invalid_option('io-scheduling-priority', value, 'expected a number between 0 (highest) and 7')
+            tuning.append(('IOSchedulingPriority', value))
+        memory = get_memory_size()
+        limits = {}
+        for name, directive in (('memory-high', 'MemoryHigh'), ('memory-max', 'MemoryMax')):
+            value = option(name)
+            if not value:
+                continue
+            size = parse_memory_size(value, memory)
+            if size is None:
+                invalid_option(name, value, 'expected a size like "6G", a percentage or "infinity"')
+            if memory and size != float('inf') and size > memory:
+                invalid_option(name, value, 'this host only has {0} of memory'.format(format_size(memory)))
+            limits[name] = size
+            tuning.append((directive, value))
+        if limits.get('memory-high', 0) > limits.get('memory-max', float('inf')):
+            invalid_option('memory-high', option('memory-high'), 'it must not be greater than memory-max')
+        value = option('limit-nofile')
+        if value:
+            if not re.match(r'^(\d+|infinity)(:(\d+|infinity))?$', value):
+                invalid_option('limit-nofile', value, 'expected a number, "infinity" or "soft:hard"')
+            tuning.append(('LimitNOFILE', value))
+        value = option('numa-node')
+        if value:
+            nodes = parse_cpu_list(value)
+            if nodes is None:
+                invalid_option('numa-node', value, 'expected a list of nodes like "0" or "0-1"')
+            for node in nodes:
+                if not os.path.isdir('/sys/devices/system/node/node{0}'.format(node)):
+                    invalid_option('numa-node', value, 'node {0} does not exist on this host'.format(node))
+            tuning.append(('NUMAPolicy', 'bind'))
+            tuning.append(('NUMAMask', ' '.join(str(node) for node in nodes)))
+        value = option('transparent-hugepages').lower()
+        if value:
+            if value not in TRANSPARENT_HUGEPAGES:
+                invalid_option('transparent-hugepages', value,
+                               'expected one of: {0}'.format(', '.join(TRANSPARENT_HUGEPAGES)))
+            # '+' runs the command as root even with User=, the setting is global to the host
+            tuning.append(('ExecStartPre', "+/bin/sh -c 'echo {0} > {1}'".format(value, THP_PATH)))
+        return tuning
+
     @property
     def factorio_service_path(self):
         return os.path.join(SYSTEMD_PATH, self.factorio_service)
@@ -145,22 +415,285 @@ class ConfigData:
     @property
     def save_path(self):
         if self._save_path is None:
-            self._save_path = get_abs_path(self.config.get('DEFAULT', 'save-path',
-                                                           fallback='../factorio/save/fsave.zip'))
+            self._save_path = get_abs_path(self.get('DEFAULT', 'save-path',
+                                                    fallback='../factorio/save/fsave.zip'))
             self.vprint('Save path configured at', self._save_path)
         return self._save_path
 
     @property
     def user(self):
         if self._user is None:
-            self._user = self.config.get('DEFAULT', 'user', fallback='root')
+            self._user = self.get('DEFAULT', 'user', fallback='root')
         return self._user
 
+    @property
+    def download_mode(self):
+        if self._download_mode is None:
+            self._download_mode = self.get('DEFAULT', 'download-mode', fallback='stream').strip().lower()
+            if self._download_mode not in DOWNLOAD_MODES:
+                print('Invalid download-mode "{0}", expected one of: {1}'
+                      .format(self._download_mode, ', '.join(DOWNLOAD_MODES)), file=sys.stderr)
+                sys.exit(-101)
+            self.vprint('Download mode:', self._download_mode)
+        return self._download_mode
+
+    @property
+    def download_segments(self):
+        if self._download_segments is None:
+            self._download_segments = max(1, self.getint('DEFAULT', 'download-segments', fallback=4))
+        return self._download_segments
+
+    @property
+    def sha256_url(self):
+        if self._sha256_url is None:
+            page = self.config.get('WEBSITE', 'sha256page', fallback='/download/sha256sums/')
+            self._sha256_url = '{0}{1}'.format(self.baseurl, page) if page else ''
+        return self._sha256_url
+
+    @property
+    def page_timeout(self):
+        if self._page_timeout is None:
+            self._page_timeout = max(1.0, self.config.getfloat('WEBSITE', 'page-timeout', fallback=10))
+        return self._page_timeout
+
+    @property
+    def wait_ready(self):
+        if self._wait_ready is None:
+            self._wait_ready = self.get('SERVICE', 'wait-ready', fallback='no').strip().lower()
+            if self._wait_ready not in READY_MODES:
+                print('Invalid wait-ready "{0}", expected one of: {1}'
+                      .format(self._wait_ready, ', '.join(READY_MODES)), file=sys.stderr)
+                sys.exit(-104)
+        return self._wait_ready
+
+    @property
+    def ready_timeout(self):
+        return max(1, self.getint('SERVICE', 'ready-timeout', fallback=300))
+
+    @property
+    def ready_log(self):
+        if self._ready_log is None:
+            default = os.path.join(self.factorio_path, 'factorio-current.log')
+            self._ready_log = get_abs_path(self.get('SERVICE', 'ready-log', fallback=default))
+        return self._ready_log
+
+    @property
+    def ready_port(self):
+        return self.getint('SERVICE', 'ready-port', fallback=34197)
+
+    @property
+    def rollback_on_failure(self):
+        return self.getboolean('SERVICE', 'rollback-on-failure', fallback=True)
+
+    @property
+    def ram_saves(self):
+        return self.getboolean('SERVICE', 'ram-saves', fallback=False)
+
+    @property
+    def ram_saves_name(self):
+        """Name of the RuntimeDirectory= of the unit, also used for the units syncing it"""
+        return '{0}-saves'.format(self.factorio_service[:-len('.service')])
+
+    @property
+    def ram_saves_path(self):
+        return os.path.join(RUNTIME_PATH, self.ram_saves_name)
+
+    @property
+    def ram_saves_interval(self):
+        return max(10, self.getint('SERVICE', 'ram-saves-sync-interval', fallback=300))
+
+    @property
+    def saves_sync_service_path(self):
+        return os.path.join(SYSTEMD_PATH, '{0}-sync.service'.format(self.ram_saves_name))
+
+    @property
+    def saves_sync_timer_path(self):
+        return os.path.join(SYSTEMD_PATH, '{0}-sync.timer'.format(self.ram_saves_name))
+
+    @property
+    def install_mode(self):
+        if self._install_mode is None:
+            self._install_mode = self.get('DEFAULT', 'install-mode', fallback='inplace').strip().lower()
+            if self._install_mode not in INSTALL_MODES:
+                print('Invalid install-mode "{0}", expected one of: {1}'
+                      .format(self._install_mode, ', '.join(INSTALL_MODES)), file=sys.stderr)
+                sys.exit(-102)
+            self.vprint('Install mode:', self._install_mode)
+        return self._install_mode
+
+    @property
+    def versions_dir(self):
+        if self._versions_dir is None:
+            default = os.path.dirname(self.factorio_path.rstrip('/'))
+            self._versions_dir = get_abs_path(self.get('DEFAULT', 'versions-path', fallback=default))
+            self.vprint('Versions are installed in', self._versions_dir)
+        return self._versions_dir
+
+    @property
+    def keep_versions(self):
+        if self._keep_versions is None:
+            self._keep_versions = max(1, self.getint('DEFAULT', 'keep-versions', fallback=3))
+        return self._keep_versions
+
+    @property
+    def incremental_update(self):
+        if self._incremental_update is None:
+            self._incremental_update = self.getboolean('DEFAULT', 'incremental-update', fallback=False)
+            if self._incremental_update:
+                self.vprint('Incremental update enabled')
+        return self._incremental_update
+
+    @property
+    def extract_backend(self):
+        if self._extract_backend is None:
+            self._extract_backend = self.get('DEFAULT', 'extract-backend', fallback='auto').strip().lower()
+            if self._extract_backend not in EXTRACT_BACKENDS:
+                print('Invalid extract-backend "{0}", expected one of: {1}'
+                      .format(self._extract_backend, ', '.join(EXTRACT_BACKENDS)), file=sys.stderr)
+                sys.exit(-103)
+        return self._extract_backend
+
+    @property
+    def extract_workers(self):
+        return max(1, self.getint('DEFAULT', 'extract-workers', fallback=4))
+
+    @property
+    def cache_path(self):
+        if self._cache_path is None:
+            default = os.path.join(os.path.dirname(self.config_path or get_abs_path('./config.ini')), 'faas_cache.json')
+            self._cache_path = get_abs_path(self.config.get('CACHE', 'cache-file', fallback=default))
+            self.vprint('Cache file:', self._cache_path)
+        return self._cache_path
+
+    @property
+    def shared_cache_path(self):
+        if self._shared_cache_path is None:
+            path = self.config.get('CACHE', 'shared-cache-path', fallback='').strip()
+            self._shared_cache_path = get_abs_path(path) if path else ''
+            if self._shared_cache_path:
+                self.vprint('Shared cache:', self._shared_cache_path)
+        return self._shared_cache_path
+
+    @property
+    def shared_cache_size(self):
+        return max(0, self.config.getint('CACHE', 'shared-cache-size', fallback=4096)) * 1024 * 1024
+
+    @property
+    def metrics_file(self):
+        if self._metrics_file is None:
+            path = self.config.get('METRICS', 'json-file', fallback='').strip()
+            self._metrics_file = get_abs_path(path) if path else ''
+        return self._metrics_file
+
+    @property
+    def prometheus_path(self):
+        if self._prometheus_path is None:
+            path = self.config.get('METRICS', 'prometheus-path', fallback='').strip()
+            self._prometheus_path = get_abs_path(path) if path else ''
+        return self._prometheus_path
+
+    @property
+    def snapshot_path(self):
+        if self._snapshot_path is None:
+            path = self.config.get('SNAPSHOT', 'path', fallback='').strip()
+            self._snapshot_path = get_abs_path(path) if path else ''
+        return self._snapshot_path
+
+    @property
+    def snapshot_keep(self):
+        return max(1, self.config.getint('SNAPSHOT', 'keep', fallback=10))
+
+    @property
+    def snapshot_max_age(self):
+        """In seconds, 0 to keep the snapshots whatever their age"""
+        return max(0, self.config.getint('SNAPSHOT', 'max-age', fallback=0)) * 24 * 3600
+
+    @property
+    def snapshot_workers(self):
+        return max(1, self.config.getint('SNAPSHOT', 'workers', fallback=4))
+
+    @property
+    def mods_sync(self):
+        return self.getboolean('DEFAULT', 'sync-mods', fallback=False)
+
+    @property
+    def mods_path(self):
+        if self._mods_path is None:
+            default = os.path.join(self.factorio_path, 'mods')
+            self._mods_path = get_abs_path(self.get('DEFAULT', 'mods-path', fallback=default))
+        return self._mods_path
+
+    @property
+    def mods_manifest(self):
+        """List of the mods to install, mod-list.json of the server by default"""
+        path = self.get('DEFAULT', 'mods-manifest', fallback='').strip()
+        return get_abs_path(path) if path else os.path.join(self.mods_path, 'mod-list.json')
+
+    @property
+    def mods_portal_url(self):
+        return self.config.get('MODS', 'portal-url', fallback='https://mods.factorio.com').rstrip('/')
+
+    @property
+    def mods_cache_path(self):
+        if self._mods_cache_path is None:
+            if self.shared_cache_path:
+                default = os.path.join(self.shared_cache_path, 'mods')
+            else:
+                default = os.path.join(os.path.dirname(self.config_path or get_abs_path('./config.ini')), 'mods-cache')
+            self._mods_cache_path = get_abs_path(self.config.get('MODS', 'cache-path', fallback=default))
+        return self._mods_cache_path
+
+    @property
+    def mods_workers(self):
+        return max(1, self.config.getint('MODS', 'workers', fallback=8))
+
+    def mods_credentials(self):
+        """Username and token of the mod portal: from the config file, or from player-data.json like the game"""
+        username = self.config.get('MODS', 'username', fallback='').strip()
+        token = self.config.get('MODS', 'token', fallback='').strip()
+        if username and token:
+            return username, token
+        path = os.path.join(self.factorio_path, 'player-data.json')
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('service-username') and data.get('service-token'):
+            self.vprint('Mod portal credentials read from', path)
+            return data['service-username'], data['service-token']
+        return None
+
+    @property
+    def page_cache_ttl(self):
+        if self._page_cache_ttl is None:
+            self._page_cache_ttl = max(0, self.config.getint('CACHE', 'page-cache-ttl', fallback=0))
+        return self._page_cache_ttl
+
 
 class FactorioCommands:
 
-    def __init__(self, vargs):
+    def __init__(self, vargs, server=None, parent=None):
         self.vargs = vargs
+        self.latest_version_data = None
+        self.metrics = UpdateMetrics()
+        if parent is None:
+            config, config_path = self._read_config()
+            self._cache = None
+            self._pages = {}
+            self._page_locks = {}
+            self._pages_lock = threading.Lock()
+            self.http = HttpClient()
+        else:
+            config, config_path = parent.config.config, parent.config.config_path
+            self._cache = parent.cache
+            self._pages = parent._pages
+            self._page_locks = parent._page_locks
+            self._pages_lock = parent._pages_lock
+            self.http = parent.http
+        self.config = ConfigData(config, self.vargs, config_path, server)
+
+    def _read_config(self):
         config = ConfigParser()
         config_path = get_abs_path(self.vargs.config_file)
         if not os.path.isfile(config_path) and config_path.lower() != './config.ini':
@@ -170,15 +703,64 @@ class FactorioCommands:
             print('\t"{0}" or'.format(get_abs_path(self.vargs.config_file)), file=sys.stderr)
             print('\t"{0}"'.format(get_abs_path('./config.ini')), file=sys.stderr)
             sys.exit(-30)
-        if vargs.verbose:
+        if self.vargs.verbose:
             print('Reading config from "{0}"'.format(config_path))
         config.read(config_path)
-        self.config = ConfigData(config, self.vargs)
-        self.latest_version_data = None
+        return config, config_path
 
     def vprint(self, *args, **kwargs):
         self.config.vprint(*args, **kwargs)
 
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = JsonStore(self.config.cache_path, self.vprint)
+        return self._cache
+
+    def for_server(self, server):
+        if server not in self.config.servers:
+            print('No section [{0}{1}] in the config file'.format(SERVER_SECTION_PREFIX, server), file=sys.stderr)
+            sys.exit(-31)
+        return FactorioCommands(self.vargs, server, self)
+
+    def instances(self):
+        """Commands of every configured server: one per [server:<name>] section, or itself"""
+        if self.config.server or not self.config.servers:
+            return [self]
+        return [self.for_server(server) for server in self.config.servers]
+
+    def update_fleet(self):
+        """Update every configured server concurrently, the download pages are only fetched once"""
+        from concurrent.futures import ThreadPoolExecutor
+        instances = self.instances()
+        with ThreadPoolExecutor(max_workers=self.config.fleet_workers) as pool:
+            futures = [pool.submit(self._timed_update, fc) for fc in instances]
+        rows = [('Server', 'Service', 'Result', 'Version', 'Time')]
+        failed = False
+        for fc, future in zip(instances, futures):
+            result, elapsed = future.result()
+            failed = failed or result.startswith('failed')
+            version = fc.latest_version_data.number.vstring if fc.latest_version_data else '-'
+            rows.append((fc.config.server or '-', fc.config.factorio_service, result, version,
+                         '{0:.1f}s'.format(elapsed)))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+        if failed:
+            sys.exit(-32)
+
+    @staticmethod
+    def _timed_update(fc):
+        start = time.time()
+        try:
+            result = 'updated' if fc.update_server() else 'up-to-date'
+        except SystemExit as err:
+            result = 'failed ({0})'.format(err.code)
+        except Exception as err:
+            print('[{0}] Update failed: {1}'.format(fc.config.server, str(err)), file=sys.stderr)
+            result = 'failed'
+        return result, time.time() - start
+
     def check_factorio_path(self, create_dir=True):
         path = self.config.factorio_path
         if os.path.exists(path):
@@ -209,13 +791,16 @@ class FactorioCommands:
         return True
 
     def _get_latest_version(self):
-        success = False
-        parser = None
         if self.config.experimental:
+            # The stable page is fetched at the same time so the fallback does not add another round trip.
+            # Nothing waits for this daemon thread when the experimental page is enough
+            stable_url = self.config.stable_url
+            threading.Thread(target=self._download_and_parse_page, args=(stable_url,), daemon=True).start()
             parser, success = self._download_and_parse_page(self.config.experimental_url)
-        if not success:
-            if self.config.experimental:
+            if not success:
                 self.vprint('Unable to find any experimental version, fallback to stable branch')
+                parser, success = self._download_and_parse_page(stable_url)
+        else:
             parser, success = self._download_and_parse_page(self.config.stable_url)
         if not success:
             print("Unable to find any factorio version a their website !", file=sys.stderr)
@@ -224,21 +809,73 @@ class FactorioCommands:
         return parser
 
     def _download_and_parse_page(self, url):
-        parser = FactorioVersionPageParser()
+        with self._pages_lock:
+            lock = self._page_locks.setdefault(url, threading.Lock())
+        with lock:
+            if url not in self._pages:
+                self._pages[url] = self._fetch_and_parse_page(url)
+            return self._pages[url]
+
+    def _fetch_and_parse_page(self, url):
+        cached = self.cache.get('pages', url)
+        latest_only = not (self.vargs.latest_version and self.config.verbose)
+        if cached and not latest_only and not cached.get('complete'):
+            cached = None
+        if cached and self.config.page_cache_ttl and time.time() - cached['fetched'] < self.config.page_cache_ttl:
+            self.vprint('Using cached version list of "{0}" ({1:.0f}s old)'
+                        .format(url, time.time() - cached['fetched']))
+            return self._parser_from_cache(url, cached)
+        import codecs
+        from urllib.error import HTTPError
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last-modified'):
+            headers['If-Modified-Since'] = cached['last-modified']
+        parser = FactorioVersionPageParser(latest_only)
         try:
-            with urlopen(url) as fs:
-                parser.feed(fs.read().decode())
+            with self.http.open(url, headers, timeout=self.config.page_timeout) as fs:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+                for chunk in iter(lambda: fs.read(PAGE_CHUNK_SIZE), b''):
+                    parser.feed(decoder.decode(chunk))
+                    if parser.done:
+                        self.vprint('Latest version found, the rest of the page is skipped')
+                        break
+                self._cache_page(url, parser, fs.headers)
             if parser.version_found:
                 return parser, True
             else:
                 self.vprint("No version found on this page !")
         except HTTPError as httperr:
+            if httperr.code == 304 and cached:
+                self.vprint('Page "{0}" not modified since last run'.format(url))
+                cached['fetched'] = time.time()
+                self.cache.set('pages', url, cached)
+                return self._parser_from_cache(url, cached)
             self.vprint('Unable to open "{0}":'.format(url))
             self.vprint('Code {0}: {1}'.format(httperr.code, httperr.msg))
         except Exception as err:
             self.vprint("Error:", str(err))
         return None, False
 
+    def _parser_from_cache(self, url, cached):
+        parser = FactorioVersionPageParser.from_versions(cached['versions'])
+        if not parser.version_found:
+            self.vprint("No version found on this page !")
+            return None, False
+        return parser, True
+
+    def _cache_page(self, url, parser, headers):
+        if not headers.get('ETag') and not headers.get('Last-Modified') and not self.config.page_cache_ttl:
+            return
+        self.cache.set('pages', url, {
+            'etag': headers.get('ETag'),
+            'last-modified': headers.get('Last-Modified'),
+            'fetched': time.time(),
+            'versions': [[v.number.vstring, v.path] for v in parser.available_version],
+            'complete': not parser.latest_only,
+        })
+
     def get_latest_version(self):
         ret = self._get_latest_version()
         if self.config.verbose:
@@ -247,44 +884,490 @@ class FactorioCommands:
             print(ret.latest_version.number)
 
     def _get_local_version(self):
-
         if not self.check_factorio_path(False):
             print('Unable to find factorio directory at', self.config.factorio_path, file=sys.stderr)
             sys.exit(-10)
         if not self.check_factorio_bin_path():
             print('Unable to execute factorio at', self.config.factorio_binary, file=sys.stderr)
             sys.exit(-11)
+        binary = self.config.factorio_binary
+        st = os.stat(binary)
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        cached = self.cache.get('local-version', binary)
+        if cached and cached['key'] == key:
+            self.vprint('Local version read from cache')
+            return str_to_version(cached['version'])
+        import subprocess
+        version = None
         try:
-            return str_to_version(subprocess.check_output([self.config.factorio_binary, '--version'],
-                                                          universal_newlines=True))
-        except subprocess.CalledProcessError:
+            version = str_to_version(subprocess.check_output([binary, '--version'], universal_newlines=True))
+        except (subprocess.CalledProcessError, OSError):
+            self.vprint('Unable to get the version from the binary')
+        if version is None:
+            version = self._get_data_version()
+        if version is None:
             self.vprint('Unable to find local version')
-        return None
+            return None
+        self.cache.set('local-version', binary, {'key': key, 'version': version.vstring})
+        return version
+
+    def _get_data_version(self):
+        path = os.path.join(self.config.factorio_path, 'data', 'base', 'info.json')
+        try:
+            with open(path) as f:
+                version = str_to_version(json.load(f).get('version'))
+        except (OSError, ValueError, AttributeError):
+            return None
+        if version is not None:
+            self.vprint('Local version read from', path)
+        return version
 
     def get_local_version(self):
         version = self._get_local_version()
         print('Version of', self.config.factorio_binary, ':', version.vstring)
 
     def update_server(self):
-        if not self.check_factorio_path(True):
+        """
+        Only one update of an installation runs at a time. A run started during another one waits for it
+        and reuses its result instead of downloading and restarting the server again.
+        """
+        import fcntl
+        try:
+            lock = open_shared_lock(self.config.update_lock_path)
+        except OSError as err:
+            print('Unable to open the update lock:', str(err), file=sys.stderr)
+            sys.exit(-35)
+        with lock:
+            started = time.time()
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return self._wait_update(lock, started)
+            try:
+                return self._locked_update_server(lock)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _locked_update_server(self, lock):
+        self.metrics = UpdateMetrics(self.config.server, self.config.factorio_service)
+        try:
+            updated = self._update_server()
+        except SystemExit as err:
+            self._write_metrics('failed')
+            self._write_update_result(lock, 'failed', err.code)
+            raise
+        result = 'updated' if updated else 'up-to-date'
+        self._write_metrics(result)
+        self._write_update_result(lock, result)
+        return updated
+
+    def _write_update_result(self, lock, result, code=None):
+        """The result is kept in the lock file for the runs waiting for this one"""
+        version = self.latest_version_data.number.vstring if self.latest_version_data else None
+        try:
+            lock.seek(0)
+            lock.truncate()
+            json.dump({'result': result, 'code': code, 'version': version, 'finished': time.time()}, lock)
+            lock.flush()
+        except OSError as err:
+            # Read-only lock of another user: the waiting runs will check for an update themselves
+            self.vprint('Unable to share the result of the update:', str(err))
+
+    def _read_update_result(self, lock):
+        """Result written by the other run, only trusted from a lock file of root or of this user"""
+        if os.fstat(lock.fileno()).st_uid not in (0, os.geteuid()):
+            self.vprint('The update lock belongs to another user, its result is ignored')
+            return None
+        lock.seek(0)
+        try:
+            data = json.loads(lock.read())
+        except ValueError:
+            return None
+        if (not isinstance(data, dict) or data.get('result') not in ('updated', 'up-to-date', 'failed')
+                or not isinstance(data.get('finished'), (int, float))):
+            return None
+        return data
+
+    def _wait_update(self, lock, started):
+        import fcntl
+        print(self._server_prefix() + 'An update of {0} is already running, waiting for it'
+              .format(self.config.factorio_path))
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = self._read_update_result(lock)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        if data is None or data['finished'] < started:
+            # The other run was killed before the end of the update, or its result cannot be trusted
+            self.vprint('No result from the other update, updating now')
+            return self.update_server()
+        print(self._server_prefix() + 'Result of the other update: {0} ({1})'
+              .format(data['result'], data.get('version') or '-'))
+        if data['result'] == 'failed':
+            sys.exit(data.get('code') if isinstance(data.get('code'), int) else -1)
+        return data['result'] == 'updated'
+
+    def _update_server(self):
+        if self.config.install_mode == 'staged':
+            self.check_versions_dir()
+        elif not self.check_factorio_path(True):
             print("Unable to create directory at:", self.config.factorio_path, file=sys.stderr)
             sys.exit(-8)
         if self.is_download_needed():
+            mods = self.prepare_mods(self.latest_version_data.number)
+            if self.config.install_mode == 'staged':
+                self._staged_update(mods)
+            else:
+                self.snapshot_save()
+                with self.metrics.phase('downtime'):
+                    self.stop_server()
+                    self.download_extract_archive()
+                    self.install_mods(mods)
+                    ready = self.start_server()
+                if not ready:
+                    print('The server did not become ready after the update', file=sys.stderr)
+                    sys.exit(-42)
+            print(self._server_prefix() + 'Server updated successfully!')
+            return True
+        if self.config.mods_sync and self.sync_mods():
+            return True
+        print(self._server_prefix() + 'No update required')
+        return False
+
+    def _write_metrics(self, result):
+        self.metrics.finish(result)
+        self.vprint('Update phases:', self.metrics.summary())
+        if self.config.metrics_file:
+            self.metrics.write_json(self.config.metrics_file, self.vprint)
+        if self.config.prometheus_path:
+            name = 'faas-{0}.prom'.format(self.config.server) if self.config.server else 'faas.prom'
+            self.metrics.write_prometheus(os.path.join(self.config.prometheus_path, name), self.vprint)
+
+    def _mod_sync(self, credentials=None):
+        return ModSync(self.config.mods_portal_url, self.config.mods_cache_path, credentials,
+                       self.config.mods_workers, self.vprint, self.http)
+
+    def prepare_mods(self, factorio_version):
+        """Resolve and download the mods for this version while the server is still running"""
+        from http.client import HTTPException
+        if not self.config.mods_sync:
+            return None
+        sync = self._mod_sync(self.config.mods_credentials())
+        with self.metrics.phase('mods'):
+            try:
+                mods = sync.read_manifest(self.config.mods_manifest)
+                releases = sync.resolve(mods, factorio_version)
+                sync.download(releases)
+            except (OSError, ValueError, HTTPException) as err:
+                print('Unable to synchronize the mods:', str(err), file=sys.stderr)
+                sys.exit(-60)
+        return releases
+
+    def install_mods(self, releases):
+        if releases is None:
+            return
+        installed, removed = self._mod_sync().install(releases, self.config.mods_path)
+        print(self._server_prefix() + 'Mods: {0} installed, {1} removed, {2} unchanged'.format(
+            len(installed), len(removed), len(releases) - len(installed)))
+        if installed:
+            self.vprint('Installed mods:', ', '.join(installed))
+
+    def sync_mods(self):
+        """Update the mods for the installed version, the server is only restarted when a mod changed"""
+        if not self.config.mods_sync:
+            print('Mod synchronization is disabled (sync-mods)', file=sys.stderr)
+            sys.exit(-62)
+        version = self._get_local_version()
+        if version is None:
+            print('Unable to find the installed version', file=sys.stderr)
+            sys.exit(-61)
+        releases = self.prepare_mods(version)
+        if not self._mod_sync().changes(releases, self.config.mods_path):
+            self.vprint('Mods are up-to-date')
+            return False
+        with self.metrics.phase('downtime'):
             self.stop_server()
-            self.download_extract_archive()
-            self.start_server()
-            print('Server updated successfully!')
-        else:
-            print('No update required')
+            self.install_mods(releases)
+            ready = self.start_server()
+        if not ready:
+            sys.exit(-42)
+        print(self._server_prefix() + 'Mods updated successfully!')
+        return True
+
+    def _snapshot_store(self):
+        if not self.config.snapshot_path:
+            print('No snapshot store configured (path in [SNAPSHOT])', file=sys.stderr)
+            sys.exit(-50)
+        return SnapshotStore(self.config.snapshot_path, self.config.snapshot_workers, self.vprint)
+
+    def _snapshot_prefix(self):
+        return self.config.server or 'default'
+
+    def snapshot_save(self):
+        """Snapshot save-path while the server is still running, so the update window is not extended"""
+        if not self.config.snapshot_path:
+            return
+        save_path = self._live_save_path()
+        if not os.path.isfile(save_path):
+            self.vprint('No save file to snapshot at', save_path)
+            return
+        store = self._snapshot_store()
+        with self.metrics.phase('snapshot'):
+            try:
+                for attempt in range(1, SNAPSHOT_RETRIES + 1):
+                    try:
+                        result = store.snapshot(save_path, self._snapshot_prefix(), self.metrics.previous)
+                        break
+                    except SaveChangedError:
+                        if attempt == SNAPSHOT_RETRIES:
+                            print(self._server_prefix() + 'Snapshot skipped, {0} kept changing (autosave ?)'
+                                  .format(save_path), file=sys.stderr)
+                            return
+                        self.vprint('The save changed during its snapshot, retrying in {0}s'
+                                    .format(SNAPSHOT_RETRY_DELAY))
+                        time.sleep(SNAPSHOT_RETRY_DELAY)
+                removed = store.prune(self._snapshot_prefix(), self.config.snapshot_keep,
+                                      self.config.snapshot_max_age)
+            except OSError as err:
+                print('Unable to snapshot {0}: {1}'.format(save_path, str(err)), file=sys.stderr)
+                sys.exit(-51)
+        print(self._server_prefix() + str(result))
+        if removed:
+            self.vprint('Snapshots removed by the retention policy:', ', '.join(removed))
+
+    def list_snapshots(self):
+        rows = [('Snapshot', 'Created', 'Version', 'Size', 'Chunks')]
+        for manifest in self._snapshot_store().manifests():
+            rows.append((manifest['name'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created'])),
+                         manifest.get('version') or '-', format_size(manifest['size']), str(len(manifest['chunks']))))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+
+    def restore_snapshot(self, name):
+        store = self._snapshot_store()
+        manifest = store.find(name, self._snapshot_prefix())
+        if manifest is None:
+            print('Snapshot "{0}" not found (see --snapshots)'.format(name), file=sys.stderr)
+            sys.exit(-52)
+        self.stop_server()
+        try:
+            store.restore(manifest, self.config.save_path)
+        except (OSError, ValueError) as err:
+            print('Unable to restore {0}: {1}'.format(manifest['name'], str(err)), file=sys.stderr)
+            sys.exit(-53)
+        print('Snapshot', manifest['name'], 'restored to', self.config.save_path)
+        if not self.start_server():
+            sys.exit(-42)
+
+    def _live_save_path(self):
+        """With ram-saves, the save written by the running server is the one in memory"""
+        if self.config.ram_saves:
+            path = os.path.join(self.config.ram_saves_path, os.path.basename(self.config.save_path))
+            if os.path.isfile(path):
+                return path
+        return self.config.save_path
+
+    def sync_saves(self):
+        """Copy the saves between the memory and the disk (ram-saves), each one toward its newer side"""
+        if not self.config.ram_saves:
+            print('The saves are not kept in memory (ram-saves)', file=sys.stderr)
+            sys.exit(-70)
+        if not os.path.isdir(self.config.ram_saves_path):
+            self.vprint('No saves in memory at', self.config.ram_saves_path)
+            return
+        sync = SaveSync(os.path.dirname(self.config.save_path), self.config.ram_saves_path, self.vprint)
+        try:
+            to_disk, to_memory = sync.sync()
+        except OSError as err:
+            print('Unable to sync the saves:', str(err), file=sys.stderr)
+            sys.exit(-71)
+        self.vprint('Saves written to the disk:', ', '.join(to_disk) or '-')
+        self.vprint('Saves written to memory:', ', '.join(to_memory) or '-')
+        print(self._server_prefix() + 'Saves synced: {0} to the disk, {1} to memory'.format(len(to_disk),
+                                                                                              len(to_memory)))
+
+    def _server_prefix(self):
+        return '[{0}] '.format(self.config.server) if self.config.server else ''
+
+    def check_versions_dir(self):
+        path = self.config.versions_dir
+        if os.path.lexists(self.config.factorio_path) and not os.path.isdir(self.config.factorio_path):
+            print("{0} is not a directory nor a link to a directory".format(self.config.factorio_path), file=sys.stderr)
+            sys.exit(-8)
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            print("Unable to create directory at:", path, file=sys.stderr)
+            sys.exit(-8)
+
+    def _staged_update(self, mods=None):
+        """Extract the new version next to the running one, then only stop the server for the symlink swap"""
+        import shutil
+        target = self._version_dir(self.latest_version_data.number.vstring)
+        staging = '{0}.staging'.format(target)
+        for path in (staging, target):
+            if os.path.lexists(path) and path != self._current_version_dir():
+                self.vprint('Removing leftover directory', path)
+                shutil.rmtree(path)
+        os.makedirs(staging)
+        self.download_extract_archive(staging)
+        shipped = set(os.listdir(staging))
+        with open(os.path.join(staging, SHIPPED_FILE), 'w') as f:
+            json.dump(sorted(shipped), f)
+        self._migrate_install()
+        previous = self._current_version_dir()
+        if previous:
+            self._sync_user_data(previous, staging, shipped)
+        os.rename(staging, target)
+        self.snapshot_save()
+        with self.metrics.phase('downtime'):
+            self.stop_server()
+            if previous:
+                # Second pass for the saves written at the stop (and the autosaves of the download)
+                self._sync_user_data(previous, target, shipped)
+            self._swap_current(target)
+            self.install_mods(mods)
+            ready = self.start_server()
+            if not ready and previous and self.config.rollback_on_failure:
+                # The user data of the previous directory is already up-to-date: it was synced after the stop
+                print('Rolling back to', os.path.basename(previous), file=sys.stderr)
+                self.stop_server()
+                self._swap_current(previous)
+                self.start_server()
+        if not ready:
+            print('Update to {0} failed: the server did not become ready'
+                  .format(self.latest_version_data.number.vstring), file=sys.stderr)
+            sys.exit(-42)
+        self._prune_versions()
+
+    def _version_dir(self, version):
+        return os.path.join(self.config.versions_dir, 'factorio-{0}'.format(version))
+
+    def _current_version_dir(self):
+        path = self.config.factorio_path
+        if not os.path.isdir(path):
+            return None
+        return os.path.realpath(path)
+
+    def _installed_versions(self):
+        """
+        Versioned directories available for a swap, most recent first. factorio-previous, moved by the first staged
+        update when its version was unknown, is the oldest one (its version is None).
+        """
+        versions = []
+        for name in os.listdir(self.config.versions_dir):
+            path = os.path.join(self.config.versions_dir, name)
+            res = re.match(r'^factorio-(\d+(\.\d+)+|previous)$', name)
+            if res and os.path.isdir(path) and not os.path.islink(path):
+                versions.append((str_to_version(res.group(1)), path))
+        return sorted(versions, key=lambda x: x[0] or VersionNumber('0'), reverse=True)
+
+    def _shipped_names(self, *paths):
+        """Entries of the game archive, as recorded by the first of these directories that has the record"""
+        for path in paths:
+            try:
+                with open(os.path.join(path, SHIPPED_FILE)) as f:
+                    return set(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return set(SHIPPED_DEFAULT)
+
+    def _sync_user_data(self, source, destination, shipped):
+        """Copy what is not part of the archive (config, saves, mods, ...) from the previous install"""
+        for name in os.listdir(source):
+            if name in shipped or name == SHIPPED_FILE:
+                continue
+            self._copy_changed(os.path.join(source, name), os.path.join(destination, name))
+
+    def _copy_changed(self, source, destination):
+        import shutil
+        if os.path.isdir(source) and not os.path.islink(source):
+            os.makedirs(destination, exist_ok=True)
+            for name in os.listdir(source):
+                self._copy_changed(os.path.join(source, name), os.path.join(destination, name))
+            return
+        try:
+            src_st, dst_st = os.lstat(source), os.lstat(destination)
+            if src_st.st_size == dst_st.st_size and int(src_st.st_mtime) == int(dst_st.st_mtime):
+                return
+        except FileNotFoundError:
+            pass
+        self.vprint('Copying', source)
+        shutil.copy2(source, destination, follow_symlinks=False)
+
+    def _migrate_install(self):
+        """
+        Before the first staged update, move the existing directory to versions-path and replace it by a symlink,
+        so that the rollback target is the moved directory. factorio-path is only missing for an instant, the
+        running server keeps its open directory.
+        """
+        import errno
+        link = self.config.factorio_path
+        if not os.path.isdir(link) or os.path.islink(link):
+            return
+        version = self._get_local_version() if self.check_factorio_bin_path() else None
+        legacy = self._version_dir(version.vstring if version else 'previous')
+        self.vprint('Moving the existing installation to', legacy)
+        try:
+            os.rename(link, legacy)
+        except OSError as err:
+            print('Unable to move {0} to {1}: {2}'.format(link, legacy, str(err)), file=sys.stderr)
+            if err.errno == errno.EXDEV:
+                print('versions-path must be on the same filesystem as factorio-path', file=sys.stderr)
+            sys.exit(-43)
+        self._swap_current(legacy)
+
+    def _swap_current(self, target):
+        link = self.config.factorio_path
+        tmp = '{0}.faas-tmp'.format(link)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.relpath(target, os.path.dirname(link)), tmp)
+        os.replace(tmp, link)
+        self.vprint(link, 'now points to', target)
+
+    def _prune_versions(self):
+        import shutil
+        current = self._current_version_dir()
+        kept = 0
+        for _, path in self._installed_versions():
+            if path == current or kept < self.config.keep_versions:
+                kept += 1
+                continue
+            self.vprint('Removing old version', path)
+            shutil.rmtree(path)
+
+    def rollback_server(self):
+        if self.config.install_mode != 'staged':
+            print('Rollback is only available with install-mode=staged', file=sys.stderr)
+            sys.exit(-40)
+        current = self._current_version_dir()
+        versions = self._installed_versions()
+        paths = [path for _, path in versions]
+        if current not in paths or paths.index(current) + 1 >= len(paths):
+            print('No previous version available for a rollback', file=sys.stderr)
+            sys.exit(-41)
+        version, target = versions[paths.index(current) + 1]
+        self.stop_server()
+        self._sync_user_data(current, target, self._shipped_names(target, current))
+        self._swap_current(target)
+        if not self.start_server():
+            sys.exit(-42)
+        print('Server rolled back to version', version.vstring if version else 'previous')
 
     def is_download_needed(self):
-        latest = self._get_latest_version().latest_version
+        with self.metrics.phase('page_fetch'):
+            latest = self._get_latest_version().latest_version
+        self.metrics.version = latest.number.vstring
         if not self.check_factorio_bin_path():
             self.vprint('No binary found, update required')
             return True
-        local_version = self._get_local_version()
+        with self.metrics.phase('version_check'):
+            local_version = self._get_local_version()
         if local_version is None:
             return True
+        self.metrics.previous = local_version.vstring
         self.vprint('Latest version:', latest.number.vstring)
         self.vprint('Local  version:', local_version.vstring)
         if latest.number > local_version:
@@ -293,27 +1376,155 @@ class FactorioCommands:
         self.vprint('Local version is up-to-date')
         return False
 
-    def download_extract_archive(self):
+    def download_extract_archive(self, destination=None):
+        destination = destination or self.config.factorio_path
         url = '{0}{1}'.format(self.config.baseurl, self.latest_version_data.path)
         self.vprint('Downloading file:', url)
-        path = '/tmp/factorio_headless.tar.xz'
-        with urlopen(url) as fs:
-            with open(path, 'wb') as f:
-                self.vprint('Creation of the archive at:', path)
-                f.write(fs.read())
-        tar = ['tar', '-xf', path, '-C', self.config.factorio_path, '--strip-components=1']
-        self.vprint("Extracting data to", self.config.factorio_path)
-        sub = subprocess.Popen(tar, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, stderr = sub.communicate()
-        if sub.returncode == 0:
-            self.vprint('Extraction succeeded')
-            os.remove(path)
-            self.vprint("Archive deleted")
+        if self.config.shared_cache_path:
+            self._shared_cache_extract_archive(url, destination)
+        elif self.config.download_mode == 'stream':
+            self._stream_extract_archive(url, destination)
         else:
-            print('Error during archive extraction:', stderr, file=sys.stderr)
+            self._download_then_extract_archive(url, destination)
+        # tar keeps the size and the mtime of the archive: the binary could look unchanged to the version cache
+        self.cache.set('local-version', self.config.factorio_binary, None)
+
+    def _extract(self, destination, fileobj=None, path=None):
+        """Extract the archive (given as an open stream or as a path) with the configured backend"""
+        extractor = get_extractor(self.config.extract_backend, self.config.extract_workers, self.vprint)
+        self.vprint('Extracting data to {0} ({1})'.format(destination, extractor))
+        start = time.time()
+        try:
+            with self.metrics.phase('extract'):
+                if path is not None:
+                    extractor.extract_file(path, destination)
+                else:
+                    extractor.extract(fileobj, destination)
+        except ExtractionError as err:
+            print('Error during archive extraction:', str(err), file=sys.stderr)
+            sys.exit(-2)
+        self.vprint('Extraction succeeded in {0:.2f}s'.format(time.time() - start))
+
+    def _use_incremental_update(self, destination):
+        return self.config.incremental_update and destination == self.config.factorio_path
+
+    def _incremental_extract(self, fileobj, destination):
+        import lzma
+        import tarfile
+        installer = IncrementalInstaller(destination, self.vprint)
+        try:
+            with self.metrics.phase('extract'):
+                installer.apply(fileobj)
+        except (tarfile.TarError, lzma.LZMAError, EOFError, ExtractionError) as err:
+            print('Error during archive extraction:', str(err), file=sys.stderr)
             sys.exit(-2)
+        print(self._server_prefix() + str(installer))
+
+    def _stream_extract_archive(self, url, destination):
+        """Pipe the HTTP response into tar chunk by chunk so decompression overlaps the download"""
+        self.vprint("Streaming archive into", destination)
+        if self._use_incremental_update(destination):
+            try:
+                with self.metrics.phase('download'), self.http.open(url) as fs:
+                    try:
+                        self._incremental_extract(fs, destination)
+                    finally:
+                        self.metrics.download_bytes += fs.bytes_read
+            except OSError as err:
+                print('Error during the incremental update:', str(err), file=sys.stderr)
+                sys.exit(-3)
+            return
+        try:
+            with self.metrics.phase('download'), self.http.open(url) as fs:
+                try:
+                    self._extract(destination, fileobj=fs)
+                finally:
+                    self.metrics.download_bytes += fs.bytes_read
+        except OSError as err:
+            print('Error while downloading the archive:', str(err), file=sys.stderr)
+            sys.exit(-3)
+
+    def _download_archive(self, url, path):
+        self.vprint('Creation of the archive at:', path)
+        downloader = ArchiveDownloader(url, path, self.config.download_segments, self.vprint, self.http)
+        try:
+            with self.metrics.phase('download'):
+                result = downloader.download()
+        except Exception as err:
+            print('Error while downloading the archive:', str(err), file=sys.stderr)
+            print('The partial download will be resumed on the next run', file=sys.stderr)
+            sys.exit(-3)
+        self.metrics.download_bytes += result.downloaded
+        self.vprint(str(result))
+        self._verify_checksum(result)
+        return result
+
+    def _download_then_extract_archive(self, url, destination):
+        path = self.config.archive_tmp_path
+        self._download_archive(url, path)
+        if self._use_incremental_update(destination):
+            with open(path, 'rb') as f:
+                self._incremental_extract(f, destination)
+        else:
+            self._extract(destination, path=path)
+        os.remove(path)
+        self.vprint("Archive deleted")
+
+    def _shared_cache_extract_archive(self, url, destination):
+        """Download each version once per host and install it with hardlinks from the deduplicated store"""
+        import lzma
+        import tarfile
+        cache = SharedCache(self.config.shared_cache_path, self.config.shared_cache_size, self.vprint)
+        version = self.latest_version_data.number.vstring
+        with cache.download_lock(version):
+            if cache.get_archive(version) is None:
+                result = self._download_archive(url, cache.download_path(version))
+                cache.add_archive(version, result.path, result.sha256)
+        try:
+            with self.metrics.phase('extract'):
+                installer = cache.install(version, destination)
+        except (tarfile.TarError, lzma.LZMAError, EOFError, ExtractionError) as err:
+            print('Error during archive extraction:', str(err), file=sys.stderr)
+            sys.exit(-2)
+        print(self._server_prefix() + str(installer))
+
+    def get_cache_stats(self):
+        if not self.config.shared_cache_path:
+            print('No shared cache configured (shared-cache-path in [CACHE])', file=sys.stderr)
+            sys.exit(-34)
+        stats = SharedCache(self.config.shared_cache_path, self.config.shared_cache_size, self.vprint).stats()
+        for label, value in stats:
+            print('{0:<22} {1}'.format(label + ':', value))
+
+    def _verify_checksum(self, result):
+        expected = self._get_expected_sha256(result.filename)
+        if expected is None:
+            self.vprint('No published checksum found for', result.filename, '(SHA-256: {0})'.format(result.sha256))
+            return
+        if expected != result.sha256:
+            os.remove(result.path)
+            print('Checksum mismatch for {0}: expected {1}, got {2}'.format(result.filename, expected, result.sha256),
+                  file=sys.stderr)
+            sys.exit(-4)
+        self.vprint('Checksum verified:', result.sha256)
+
+    def _get_expected_sha256(self, filename):
+        if not self.config.sha256_url or not filename:
+            return None
+        try:
+            with self.http.open(self.config.sha256_url, timeout=self.config.page_timeout) as fs:
+                content = fs.read().decode()
+        except Exception as err:
+            self.vprint('Unable to download checksums from', self.config.sha256_url, ':', str(err))
+            return None
+        for line in content.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].lstrip('*') == filename:
+                return parts[0].lower()
+        return None
 
     def stop_server(self):
+        import subprocess
         if not self._service_file_exists():
             self.vprint('Service is not configured yet (unable to start it)')
             return
@@ -324,16 +1535,112 @@ class FactorioCommands:
         _, _ = sub.communicate()
 
     def start_server(self):
+        """Returns False if the server did not become ready before ready-timeout (always True without wait-ready)"""
+        import subprocess
         if not self._service_file_exists():
             self.vprint('Service is not configured yet (unable to start it)')
-            return
+            return True
         else:
             self.vprint('Starting service...')
+        start = time.time()
+        log_position = self._log_position() if self.config.wait_ready == 'log' else None
         command = ['sudo', '/bin/systemctl', 'start', self.config.factorio_service]
         sub = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         _, _ = sub.communicate()
+        if self.config.wait_ready == 'no':
+            return True
+        self.vprint('Waiting for the server to be ready ({0}, timeout: {1}s)'
+                    .format(self.config.wait_ready, self.config.ready_timeout))
+        deadline = start + self.config.ready_timeout
+        with self.metrics.phase('ready'):
+            if self.config.wait_ready == 'log':
+                ready = self._wait_log(log_position, deadline)
+            elif self.config.wait_ready == 'journal':
+                ready = self._wait_journal(start, deadline)
+            else:
+                ready = self._wait_port(deadline)
+        if ready:
+            print(self._server_prefix() + 'Server ready in {0:.1f}s'.format(time.time() - start))
+        else:
+            print(self._server_prefix() + 'Server not ready after {0}s'.format(self.config.ready_timeout),
+                  file=sys.stderr)
+        return ready
+
+    def _log_position(self):
+        """Inode and size of the log before the start: the server replaces or truncates it when it starts"""
+        try:
+            st = os.stat(self.config.ready_log)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def _wait_log(self, position, deadline):
+        ino, offset = position
+        pending = b''
+        while time.time() < deadline:
+            try:
+                st = os.stat(self.config.ready_log)
+            except OSError:
+                st = None
+            if st is not None and (st.st_ino != ino or st.st_size < offset):
+                ino, offset, pending = st.st_ino, 0, b''
+            if st is not None and st.st_size > offset:
+                with open(self.config.ready_log, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                offset += len(data)
+                pending, ready = match_ready_lines(pending + data)
+                if ready:
+                    return True
+            time.sleep(READY_POLL_INTERVAL)
+        return False
+
+    def _wait_journal(self, since, deadline):
+        import select
+        import subprocess
+        command = ['journalctl', '-u', self.config.factorio_service, '-o', 'cat', '-f',
+                   '--since', '@{0}'.format(int(since))]
+        try:
+            sub = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as err:
+            print('Unable to read the journal:', str(err), file=sys.stderr)
+            return False
+        pending = b''
+        try:
+            while time.time() < deadline:
+                readable, _, _ = select.select([sub.stdout], [], [], deadline - time.time())
+                if not readable:
+                    break
+                data = os.read(sub.stdout.fileno(), PAGE_CHUNK_SIZE)
+                if not data:
+                    break
+                pending, ready = match_ready_lines(pending + data)
+                if ready:
+                    return True
+        finally:
+            sub.kill()
+            sub.wait()
+        return False
+
+    def _wait_port(self, deadline):
+        """The game port is bound by the server once it is hosting (only works for a local server)"""
+        while time.time() < deadline:
+            if is_udp_port_bound(self.config.ready_port):
+                return True
+            time.sleep(READY_POLL_INTERVAL)
+        return False
 
     def create_service(self):
+        if self.vargs.dry_run:
+            units = [(self.config.factorio_service_path, self.render_service()),
+                     (self.config.updater_service_path, self.render_updater_service())]
+            if self.config.ram_saves:
+                units += [(self.config.saves_sync_service_path, self.render_saves_sync_service()),
+                          (self.config.saves_sync_timer_path, self.render_saves_sync_timer())]
+            for path, unit in units:
+                print('# {0}'.format(path))
+                print(unit)
+            return
         check_root_permission()
         self.vprint('You have root permissions')
         check_systemd_dir()
@@ -344,10 +1651,14 @@ class FactorioCommands:
             sys.exit(-9)
         self.stop_server()
         self._write_service()
+        self._write_updater_service()
+        if self.config.ram_saves:
+            self._write_saves_sync_units()
         self._manage_service_permissions()
         self._reload_daemon_service()
         print('Service successfully created')
-        self.start_server()
+        if not self.start_server():
+            sys.exit(-42)
 
     def _manage_service_permissions(self):
         rules = ['ALL ALL=(ALL) NOPASSWD: /bin/systemctl start {0}'.format(self.config.factorio_service),
@@ -362,6 +1673,7 @@ class FactorioCommands:
         os.chmod(rule_path, 0o440)
 
     def _reload_daemon_service(self):
+        import subprocess
         sub = subprocess.Popen(['systemctl', 'daemon-reload'], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         stdout, stderr = sub.communicate()
         if sub.returncode == 0:
@@ -377,6 +1689,13 @@ class FactorioCommands:
 
     def _write_service(self):
         path = self.config.factorio_service_path
+        service = self.render_service()
+        with open(path, 'w') as f:
+            self.vprint('Creating service file at:', path)
+            f.write(service)
+
+    def render_service(self):
+        """Content of the systemd unit of the server"""
         user = self.config.user
         check_user_exists(user)
         if not os.path.isfile(self.config.save_path):
@@ -387,39 +1706,249 @@ class FactorioCommands:
         settings_command = ''
         if settings_path:
             settings_command = ' --server-settings {0}'.format(settings_path)
-        service = '''
-[Unit]
+        tuning = ''.join('{0}={1}\n'.format(directive, value) for directive, value in self.config.service_tuning)
+        dependencies = ''
+        if self.config.ram_saves:
+            dependencies = 'Wants={0}\n'.format(os.path.basename(self.config.saves_sync_timer_path))
+            tuning += ''.join('{0}={1}\n'.format(directive, value) for directive, value in self._ram_saves_directives())
+        return '''[Unit]
 Description=Factorio Server
 After=network.target
-
+{6}
 [Service]
 Type=simple
 User={0}
 WorkingDirectory={1}
 ExecStart={2} --start-server {3}{4}
-        '''.format(user, self.config.factorio_path, self.config.factorio_binary,
-                   self.config.save_path, settings_command)
+{5}'''.format(user, self.config.factorio_path, self.config.factorio_binary,
+              self.config.save_path, settings_command, tuning, dependencies)
+
+    def _ram_saves_directives(self):
+        """
+        The directory of the save is replaced by a tmpfs directory for the server (autosaves included).
+        '+' runs the syncs outside of this mount namespace, where both directories are visible
+        """
+        saves_path = os.path.dirname(self.config.save_path)
+        factorio_path = os.path.join(self.config.factorio_path, '')
+        if factorio_path.startswith(os.path.join(saves_path, '')):
+            invalid_option('save-path', self.config.save_path,
+                           'ram-saves needs the save in its own directory, like <factorio-path>/saves')
+        return [('RuntimeDirectory', self.config.ram_saves_name),
+                ('RuntimeDirectoryPreserve', 'yes'),
+                ('BindPaths', '{0}:{1}'.format(self.config.ram_saves_path, saves_path)),
+                ('ExecStartPre', '+{0}'.format(self._sync_saves_command())),
+                ('ExecStopPost', '+{0}'.format(self._sync_saves_command()))]
+
+    def _sync_saves_command(self):
+        server = ' -s {0}'.format(self.config.server) if self.config.server else ''
+        return '{0} {1} --sync-saves -C {2}{3}'.format(sys.executable, os.path.abspath(__file__),
+                                                       self.config.config_path, server)
+
+    def _write_saves_sync_units(self):
+        for path, unit in ((self.config.saves_sync_service_path, self.render_saves_sync_service()),
+                           (self.config.saves_sync_timer_path, self.render_saves_sync_timer())):
+            with open(path, 'w') as f:
+                self.vprint('Creating saves sync unit at:', path)
+                f.write(unit)
+
+    def render_saves_sync_service(self):
+        """Unit copying the saves of the server from memory to the disk, started by the timer"""
+        return '''[Unit]
+Description=Sync the saves of {0} to the disk
+
+[Service]
+Type=oneshot
+User={1}
+ExecStart={2}
+'''.format(self.config.factorio_service, self.config.user, self._sync_saves_command())
+
+    def render_saves_sync_timer(self):
+        """Timer started and stopped with the server"""
+        return '''[Unit]
+Description=Sync the saves of {0} to the disk every {1}s
+PartOf={0}
+After={0}
+
+[Timer]
+OnActiveSec={1}
+OnUnitActiveSec={1}
+Unit={2}
+'''.format(self.config.factorio_service, self.config.ram_saves_interval,
+           os.path.basename(self.config.saves_sync_service_path))
+
+    def _write_updater_service(self):
+        path = self.config.updater_service_path
+        service = self.render_updater_service()
         with open(path, 'w') as f:
-            self.vprint('Creating service file at:', path)
+            self.vprint('Creating updater service file at:', path)
             f.write(service)
 
+    def render_updater_service(self):
+        """Unit running 'faas.py --daemon', to use instead of a cron"""
+        return '''[Unit]
+Description=Factorio As A Service updater
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=simple
+User={0}
+Environment=PYTHONUNBUFFERED=1
+ExecStart={1} {2} --daemon -C {3}
+ExecReload=/bin/kill -HUP $MAINPID
+Restart=on-failure
+RestartSec=60
+
+[Install]
+WantedBy=multi-user.target
+'''.format(self.config.user, sys.executable, os.path.abspath(__file__), self.config.config_path)
+
     def get_server_settings_path(self):
-        if not self.config.config.getboolean('DEFAULT', 'custom-settings-path', fallback=False):
+        if not self.config.getboolean('DEFAULT', 'custom-settings-path', fallback=False):
             self.vprint('No settings file specified')
             return None
-        path = get_abs_path(self.config.config.get('DEFAULT', 'settings-path', fallback=''))
+        path = get_abs_path(self.config.get('DEFAULT', 'settings-path', fallback=''))
         if not os.path.isfile(path):
             print('Unable to find settings file at:', path, file=sys.stderr)
             sys.exit(-16)
         return path
 
 
+class VersionNumber(tuple):
+    """Version compared as a tuple of integers (replaces the deprecated distutils LooseVersion)"""
+
+    def __new__(cls, vstring):
+        number = super().__new__(cls, map(int, vstring.split('.')))
+        number.vstring = vstring
+        return number
+
+    def __str__(self):
+        return self.vstring
+
+    def __repr__(self):
+        return "VersionNumber('{0}')".format(self.vstring)
+
+
 def str_to_version(version):
-    version = str(version or '').strip()
-    res = re.search(r'\d+(\.\d+)+', version)
+    res = VERSION_RE.search(str(version or ''))
     if not res:
         return None
-    return LooseVersion(res.group())
+    return VersionNumber(res.group())
+
+
+def strip_archive_component(name):
+    """Equivalent of tar --strip-components=1, None for the root entry or an unsafe path"""
+    parts = os.path.normpath(name).split(os.sep)[1:]
+    if not parts or parts[0] in ('', '.', '..') or '..' in parts or os.path.isabs(name):
+        return None
+    return os.path.join(*parts)
+
+
+def match_ready_lines(data):
+    """Returns the incomplete last line and whether a complete line tells that the server is ready"""
+    lines = data.split(b'\n')
+    pending = lines.pop()
+    return pending, any(READY_RE.search(line.decode('utf-8', 'replace')) for line in lines)
+
+
+def is_udp_port_bound(port):
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.bind(('', port))
+        except OSError:
+            return True
+    return False
+
+
+def invalid_option(option, value, reason):
+    print('Invalid {0} "{1}", {2}'.format(option, value, reason), file=sys.stderr)
+    sys.exit(-105)
+
+
+def parse_cpu_list(value):
+    """Sorted numbers of a list like '0-3,8 10', None if the list is invalid"""
+    numbers = set()
+    for part in re.split(r'[\s,]+', value.strip()):
+        res = re.match(r'^(\d+)(-(\d+))?$', part)
+        if not res:
+            return None
+        first, last = int(res.group(1)), int(res.group(3) or res.group(1))
+        if last < first:
+            return None
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)
+
+
+def parse_memory_size(value, memory=None):
+    """Size in bytes of a systemd memory limit (1024 based suffixes, % of the memory of the host, infinity)"""
+    value = value.strip()
+    if value == 'infinity':
+        return float('inf')
+    res = re.match(r'^(\d+(\.\d+)?)%$', value)
+    if res:
+        percent = float(res.group(1))
+        if not 0 < percent <= 100:
+            return None
+        return percent * memory / 100 if memory else 0
+    res = re.match(r'^(\d+)([KMGT]?)$', value, re.I)
+    if not res:
+        return None
+    return int(res.group(1)) * 1024 ** ' KMGT'.index(res.group(2).upper() or ' ')
+
+
+def get_memory_size():
+    """Total memory of the host in bytes, None when /proc/meminfo is not available"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                res = re.match(r'^MemTotal:\s+(\d+) kB', line)
+                if res:
+                    return int(res.group(1)) * 1024
+    except OSError:
+        pass
+    return None
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by the threads and the processes of the host"""
+    import fcntl
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_shared_lock(path):
+    """
+    Open a lock file shared by all the users: it is created readable by everyone but only writable by its owner,
+    then always opened without O_CREAT (refused by fs.protected_regular on the file of another user in /tmp).
+    The file of another user is opened read-only, it can still be locked.
+    """
+    while True:
+        try:
+            return open(path, 'r+')
+        except PermissionError:
+            return open(path, 'r')
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            continue
+        os.fchmod(fd, 0o644)
+        return os.fdopen(fd, 'r+')
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} GB'.format(size)
 
 
 def get_abs_path(path):
@@ -466,16 +1995,1627 @@ def check_user_exists(username):
     sys.exit(-10)
 
 
-class FactorioVersionPageParser(HTMLParser):
+class HttpClient:
+    """
+    HTTP client keeping a pool of idle keep-alive connections per host, safe to share between threads.
+    A connection goes back to the pool once its response has been read entirely, otherwise it is closed.
+    Like urlopen, the proxies of the environment are used (http_proxy, https_proxy and no_proxy).
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._proxies = {}
+        self._lock = threading.Lock()
+
+    def _proxy(self, key):
+        """(host, port, Proxy-Authorization header) of the proxy used for a host, None for a direct connection"""
+        if key not in self._proxies:
+            from urllib.parse import unquote, urlparse
+            from urllib.request import getproxies, proxy_bypass
+            proxy = getproxies().get(key[0])
+            if proxy and not proxy_bypass(key[1]):
+                parsed = urlparse(proxy if '://' in proxy else 'http://{0}'.format(proxy))
+                authorization = None
+                if parsed.username:
+                    import base64
+                    credentials = '{0}:{1}'.format(unquote(parsed.username), unquote(parsed.password or ''))
+                    authorization = 'Basic {0}'.format(base64.b64encode(credentials.encode()).decode())
+                self._proxies[key] = (parsed.hostname, parsed.port or 80, authorization)
+            else:
+                self._proxies[key] = None
+        return self._proxies[key]
+
+    def _acquire(self, key, timeout):
+        from http.client import HTTPConnection, HTTPSConnection
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            cls = HTTPSConnection if key[0] == 'https' else HTTPConnection
+            proxy = self._proxy(key)
+            if proxy is None:
+                return cls(key[1], timeout=timeout), False
+            connection = cls(proxy[0], proxy[1], timeout=timeout)
+            if key[0] == 'https':
+                # The TLS connection goes through a CONNECT tunnel of the proxy
+                connection.set_tunnel(key[1], headers={'Proxy-Authorization': proxy[2]} if proxy[2] else None)
+            return connection, False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _release(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def open(self, url, headers=None, timeout=None, raise_errors=True):
+        """
+        Streamed response of a GET request, following redirections. Like urlopen, a HTTPError is raised
+        for the non 2xx statuses unless raise_errors is False. Use it as a context manager.
+        """
+        from urllib.error import HTTPError
+        from urllib.parse import urljoin, urlparse
+        for _ in range(HTTP_MAX_REDIRECTS):
+            parsed = urlparse(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path = '{0}?{1}'.format(path, parsed.query)
+            key = (parsed.scheme, parsed.netloc)
+            request_headers = dict(headers or {})
+            proxy = self._proxy(key)
+            if proxy and parsed.scheme == 'http':
+                # A HTTP proxy is sent the absolute url
+                path = '{0}://{1}{2}'.format(parsed.scheme, parsed.netloc, path)
+                if proxy[2]:
+                    request_headers['Proxy-Authorization'] = proxy[2]
+            connection, response = self._request(key, path, request_headers, timeout or self.timeout)
+            response = HttpResponse(self, key, connection, response, url)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                with response:
+                    response.read()
+                url = urljoin(url, response.headers.get('Location'))
+                continue
+            if raise_errors and not 200 <= response.status < 300:
+                with response:
+                    response.read()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return response
+        raise IOError('Too many redirections for {0}'.format(url))
+
+    def get(self, url, headers=None):
+        """Returns (status, headers, body, final url), following redirections"""
+        with self.open(url, headers, raise_errors=False) as response:
+            return response.status, response.headers, response.read(), response.url
+
+    def _request(self, key, path, headers, timeout):
+        from http.client import HTTPException
+        while True:
+            connection, reused = self._acquire(key, timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except (OSError, HTTPException):
+                # The server may have closed the idle connection: retry with the next one
+                connection.close()
+                if not reused:
+                    raise
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class HttpResponse:
+    """Response of HttpClient.open, giving its connection back to the pool when closed"""
+
+    def __init__(self, client, key, connection, response, url):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.bytes_read = 0
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self.bytes_read += len(data)
+        return data
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._client._release(self._key, self._connection)
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class UpdateDaemon:
+    """
+    Long-running replacement of the update cron: the config is loaded once, the download pages are polled
+    on a jittered schedule over keep-alive connections, and an update only runs when a page changed.
+    SIGHUP reloads the config file.
+    """
 
-    def __init__(self):
-        self.Version = namedtuple('Version', 'number path')
-        self.available_version = []
+    def __init__(self, vargs, fc):
+        self.vargs = vargs
+        self.fc = fc
+        self.http = fc.http
+        self._etags = {}
+        self._latest = {}
+        self._update_pending = True
+        self._stopping = False
+        self._wakeup = None
+
+    def run(self):
+        import asyncio
+        print('Update daemon started (every {0}s +/- {1}s)'.format(self.fc.config.poll_interval,
+                                                                    self.fc.config.poll_jitter))
+        asyncio.run(self._main())
+        self.http.close()
+        print('Update daemon stopped')
+
+    async def _main(self):
+        import asyncio
+        import random
+        import signal
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, self._reload)
+        loop.add_signal_handler(signal.SIGTERM, self._stop)
+        loop.add_signal_handler(signal.SIGINT, self._stop)
+        while not self._stopping:
+            await loop.run_in_executor(None, self._check)
+            config = self.fc.config
+            delay = config.poll_interval + random.uniform(-config.poll_jitter, config.poll_jitter)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(1, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    def _stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _reload(self):
+        print('Reloading config file')
+        try:
+            fc = FactorioCommands(self.vargs)
+            self.fc = fc.for_server(self.vargs.server) if self.vargs.server else fc
+        except SystemExit:
+            print('Unable to reload the config file, keeping the previous one', file=sys.stderr)
+            return
+        # The new config comes with its own client, the idle connections of the previous one are closed
+        previous, self.http = self.http, self.fc.http
+        previous.close()
+        self._update_pending = True
+        self._wakeup.set()
+
+    def _page_urls(self):
+        urls = []
+        for fc in self.fc.instances():
+            for url in ([fc.config.experimental_url] if fc.config.experimental else []) + [fc.config.stable_url]:
+                if url not in urls:
+                    urls.append(url)
+        return urls
+
+    def _poll(self, url):
+        """Returns the parsed page, or None when it did not change since the previous poll"""
+        headers = {'If-None-Match': self._etags[url]} if url in self._etags else {}
+        status, response_headers, body, _ = self.http.get(url, headers)
+        if status == 304:
+            return None
+        if status != 200:
+            raise IOError('HTTP {0} for {1}'.format(status, url))
+        if response_headers.get('ETag'):
+            self._etags[url] = response_headers.get('ETag')
+        parser = FactorioVersionPageParser(latest_only=True)
+        parser.feed(body.decode())
+        return parser
+
+    def _check(self):
+        from http.client import HTTPException
+        pages = {}
+        for url in self._page_urls():
+            try:
+                parser = self._poll(url)
+            except (OSError, HTTPException) as err:
+                print('Unable to poll {0}: {1}'.format(url, str(err)), file=sys.stderr)
+                continue
+            if parser is None or not parser.version_found:
+                continue
+            pages[url] = (parser, True)
+            latest = parser.latest_version.number
+            if self._latest.get(url) != latest:
+                self.fc.vprint('Latest version on {0}: {1}'.format(url, latest.vstring))
+                self._latest[url] = latest
+                self._update_pending = True
+        if not self._update_pending:
+            self.fc.vprint('No new version')
+            return
+        with self.fc._pages_lock:
+            self.fc._pages.clear()
+            self.fc._pages.update(pages)
+        try:
+            if self.fc.config.server or not self.fc.config.servers:
+                self.fc.update_server()
+            else:
+                self.fc.update_fleet()
+            self._update_pending = False
+        except SystemExit as err:
+            print('Update failed ({0}), it will be retried at the next poll'.format(err.code), file=sys.stderr)
+        finally:
+            with self.fc._pages_lock:
+                self.fc._pages.clear()
+
+
+class JsonStore:
+    """Small JSON file used to keep data between runs. Failing to write it is never fatal"""
+
+    def __init__(self, path, vprint=print):
+        self.path = path
+        self.vprint = vprint
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def get(self, section, key, default=None):
+        with self._lock:
+            return self._load().get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        with self._lock:
+            self._load().setdefault(section, {})[key] = value
+            self._save()
+
+    def _save(self):
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._data, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            self.vprint('Unable to write cache file', self.path, ':', str(err))
+
+
+class UpdateMetrics:
+    """Duration of each phase of an update, exported as JSON lines and for the Prometheus textfile collector"""
+
+    PHASES = ('page_fetch', 'version_check', 'mods', 'snapshot', 'download', 'extract', 'ready', 'downtime', 'total')
+
+    def __init__(self, server=None, service=None):
+        self.server = server
+        self.service = service
+        self.start = time.time()
+        self.phases = {}
+        self.download_bytes = 0
+        self.version = None
+        self.previous = None
+        self.result = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def finish(self, result):
+        self.result = result
+        self.phases['total'] = time.time() - self.start
+
+    @property
+    def download_rate(self):
+        elapsed = self.phases.get('download')
+        return self.download_bytes / elapsed if elapsed else 0
+
+    def summary(self):
+        ls = ['{0} {1:.2f}s'.format(name, self.phases[name]) for name in self.PHASES if name in self.phases]
+        if self.download_bytes:
+            ls.append('{0} at {1}/s'.format(format_size(self.download_bytes), format_size(self.download_rate)))
+        return ', '.join(ls)
+
+    def to_dict(self):
+        return {
+            'time': self.start,
+            'server': self.server,
+            'service': self.service,
+            'result': self.result,
+            'version': self.version,
+            'previous': self.previous,
+            'phases': {name: round(value, 6) for name, value in self.phases.items()},
+            'download_bytes': self.download_bytes,
+            'download_rate': round(self.download_rate),
+        }
+
+    def write_json(self, path, vprint=print):
+        """Append one line per update, the file can be read with any JSON lines tool"""
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.to_dict(), sort_keys=True) + '\n')
+        except OSError as err:
+            vprint('Unable to write metrics to', path, ':', str(err))
+
+    def write_prometheus(self, path, vprint=print):
+        """The file is replaced atomically, the collector only reads the *.prom files"""
+        labels = 'service="{0}"'.format(self.service)
+        if self.server:
+            labels += ',server="{0}"'.format(self.server)
+        ls = ['# HELP faas_update_phase_seconds Duration of each phase of the last update run',
+              '# TYPE faas_update_phase_seconds gauge']
+        for name in self.PHASES:
+            if name in self.phases:
+                ls.append('faas_update_phase_seconds{{{0},phase="{1}"}} {2:.6f}'
+                          .format(labels, name, self.phases[name]))
+        ls += ['# HELP faas_update_download_bytes Bytes downloaded by the last update run',
+               '# TYPE faas_update_download_bytes gauge',
+               'faas_update_download_bytes{{{0}}} {1}'.format(labels, self.download_bytes),
+               '# HELP faas_update_download_bytes_per_second Download throughput of the last update run',
+               '# TYPE faas_update_download_bytes_per_second gauge',
+               'faas_update_download_bytes_per_second{{{0}}} {1:.0f}'.format(labels, self.download_rate),
+               '# HELP faas_update_last_run_timestamp_seconds Start of the last update run',
+               '# TYPE faas_update_last_run_timestamp_seconds gauge',
+               'faas_update_last_run_timestamp_seconds{{{0}}} {1:.0f}'.format(labels, self.start),
+               '# HELP faas_update_success Whether the last update run succeeded',
+               '# TYPE faas_update_success gauge',
+               'faas_update_success{{{0}}} {1}'.format(labels, 0 if self.result == 'failed' else 1),
+               '# HELP faas_update_updated Whether the last update run installed a new version',
+               '# TYPE faas_update_updated gauge',
+               'faas_update_updated{{{0}}} {1}'.format(labels, 1 if self.result == 'updated' else 0)]
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(ls) + '\n')
+            os.replace(tmp, path)
+        except OSError as err:
+            vprint('Unable to write metrics to', path, ':', str(err))
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class SaveChangedError(OSError):
+    pass
+
+
+def get_extractor(backend='auto', workers=4, vprint=print):
+    import shutil
+    if backend == 'tar' or (backend == 'auto' and shutil.which('tar')):
+        return TarExtractor(vprint)
+    return PythonExtractor(workers, vprint)
+
+
+class TarExtractor:
+    """Extract with GNU tar, using a multi-threaded xz decompressor when one is installed"""
+
+    def __init__(self, vprint=print):
+        self.vprint = vprint
+        self.decompressor = self._find_decompressor()
+
+    def __str__(self):
+        return 'tar + {0}'.format(self.decompressor or 'xz')
+
+    @staticmethod
+    def _find_decompressor():
+        import shutil
+        import subprocess
+        if shutil.which('pixz'):
+            return 'pixz -d'
+        if shutil.which('xz'):
+            try:
+                output = subprocess.check_output(['xz', '--version'], universal_newlines=True)
+            except (subprocess.CalledProcessError, OSError):
+                return None
+            version = str_to_version(output)
+            if version is not None and version >= str_to_version('5.4'):
+                return 'xz -d -T0'
+        return None
+
+    def _command(self, source, destination):
+        if self.decompressor:
+            return ['tar', '-x', '-I', self.decompressor, '-f', source, '-C', destination, '--strip-components=1']
+        return ['tar', '-xJf', source, '-C', destination, '--strip-components=1']
+
+    def extract_file(self, path, destination):
+        import subprocess
+        sub = subprocess.Popen(self._command(path, destination), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        _, stderr = sub.communicate()
+        if sub.returncode != 0:
+            raise ExtractionError(stderr.decode(errors='replace'))
+
+    def extract(self, fileobj, destination):
+        """Pipe the stream into tar chunk by chunk so decompression overlaps the download"""
+        import subprocess
+        import tempfile
+        with tempfile.TemporaryFile() as errors:
+            sub = subprocess.Popen(self._command('-', destination), stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=errors)
+            received = 0
+            try:
+                for chunk in iter(lambda: fileobj.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    sub.stdin.write(chunk)
+                    received += len(chunk)
+                sub.stdin.close()
+            except BrokenPipeError:
+                self.vprint('Extraction process exited before the end of the archive')
+            except BaseException:
+                sub.kill()
+                sub.wait()
+                raise
+            sub.wait()
+            errors.seek(0)
+            stderr = errors.read()
+        self.vprint('{0} bytes received'.format(received))
+        if sub.returncode != 0:
+            raise ExtractionError(stderr.decode(errors='replace'))
+
+
+class PythonExtractor:
+    """
+    In-process extraction with tarfile/lzma: the archive is decompressed sequentially
+    while the files are written by a thread pool (bounded by the amount of pending data)
+    """
+
+    def __init__(self, workers=4, vprint=print):
+        self.workers = workers
+        self.vprint = vprint
+        self._pending = threading.Semaphore(EXTRACT_MAX_PENDING // DOWNLOAD_CHUNK_SIZE)
+
+    def __str__(self):
+        return 'python, {0} writer threads'.format(self.workers)
+
+    def extract_file(self, path, destination):
+        with open(path, 'rb') as f:
+            self.extract(f, destination)
+
+    def extract(self, fileobj, destination):
+        import lzma
+        import tarfile
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures, hardlinks = [], []
+                with tarfile.open(fileobj=fileobj, mode='r|xz') as tar:
+                    for member in tar:
+                        name = strip_archive_component(member.name)
+                        if name is None:
+                            continue
+                        path = os.path.join(destination, name)
+                        if member.isdir():
+                            os.makedirs(path, exist_ok=True)
+                        elif member.issym():
+                            futures.append(pool.submit(self._write_symlink, member.linkname, path))
+                        elif member.islnk():
+                            # Linked once every file is written
+                            hardlinks.append((hardlink_target(member, destination), path))
+                        elif member.isfile() and member.size > EXTRACT_MAX_PENDING // 2:
+                            data = tar.extractfile(member)
+                            self._write_file(iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''), member, path)
+                        elif member.isfile():
+                            futures.append(pool.submit(self._write_file, self._read(tar, member), member, path,
+                                                       self._pending))
+                for future in futures:
+                    future.result()
+            for target, path in hardlinks:
+                write_hardlink(target, path)
+        except (tarfile.TarError, lzma.LZMAError, EOFError) as err:
+            raise ExtractionError(str(err))
+
+    def _read(self, tar, member):
+        chunks = []
+        data = tar.extractfile(member)
+        for chunk in iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''):
+            self._pending.acquire()
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def _write_symlink(target, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(target, path)
+
+    @staticmethod
+    def _write_file(chunks, member, path, pending=None):
+        """Write the file, releasing the pending data of the buffered chunks (even on failure)"""
+        count = len(chunks) if pending is not None else 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{0}.faas-tmp'.format(path)
+            with open(tmp, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if count:
+                        pending.release()
+                        count -= 1
+            os.chmod(tmp, member.mode)
+            os.utime(tmp, (member.mtime, member.mtime))
+            os.replace(tmp, path)
+        finally:
+            for _ in range(count):
+                pending.release()
+
+
+class IncrementalInstaller:
+    """
+    Apply an archive over an existing installation, only rewriting the files whose content changed.
+    A manifest (size, mtime, SHA-256) of the installed files is kept so unchanged files are not read back from the disk,
+    and files that disappeared from the archive are removed.
+    """
+
+    MANIFEST = '.faas_manifest.json'
+
+    def __init__(self, destination, vprint=print):
+        self.destination = destination
+        self.vprint = vprint
+        self.manifest_path = os.path.join(destination, self.MANIFEST)
+        self.files_written = 0
+        self.files_skipped = 0
+        self.files_removed = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def __str__(self):
+        return 'Incremental update: {0} files written ({1} bytes), {2} unchanged ({3} bytes), {4} removed'.format(
+            self.files_written, self.bytes_written, self.files_skipped, self.bytes_skipped, self.files_removed)
+
+    def apply(self, fileobj):
+        import tarfile
+        previous = self._load_manifest()
+        manifest = {}
+        with tarfile.open(fileobj=fileobj, mode='r|xz') as tar:
+            for member in tar:
+                name = strip_archive_component(member.name)
+                if name is None:
+                    continue
+                path = os.path.join(self.destination, name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                elif member.issym():
+                    self._apply_symlink(member.linkname, path)
+                elif member.islnk():
+                    target = strip_archive_component(member.linkname)
+                    if target not in manifest:
+                        raise ExtractionError('{0} is a link to {1}, not a file of the archive'
+                                              .format(member.name, member.linkname))
+                    manifest[name] = self._apply_hardlink(os.path.join(self.destination, target), path,
+                                                          manifest[target])
+                elif member.isfile():
+                    manifest[name] = self._apply_file(tar.extractfile(member), member, path, previous.get(name))
+        for name in set(previous) - set(manifest):
+            path = os.path.join(self.destination, name)
+            if os.path.lexists(path):
+                self.vprint('Removing', path)
+                os.remove(path)
+                self.files_removed += 1
+        self._save_manifest(manifest)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        tmp = '{0}.tmp'.format(self.manifest_path)
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def _apply_symlink(self, target, path):
+        if os.path.islink(path) and os.readlink(path) == target:
+            return
+        if os.path.lexists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(target, path)
+
+    def _apply_hardlink(self, target, path, entry):
+        """Same manifest entry as the file it is linked to"""
+        if os.path.exists(path) and os.path.samefile(target, path):
+            self.files_skipped += 1
+            self.bytes_skipped += entry[0]
+        else:
+            write_hardlink(target, path)
+            self.files_written += 1
+            self.bytes_written += entry[0]
+        return entry
+
+    def _installed_digest(self, path, entry):
+        """SHA-256 of the installed file, taken from the manifest when the file was not touched since"""
+        import hashlib
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return st.st_size, entry[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return st.st_size, sha.hexdigest()
+
+    def _apply_file(self, data, member, path, entry):
+        import hashlib
+        import tempfile
+        size, digest = self._installed_digest(path, entry)
+        if size != member.size:
+            digest = self._write_file(data, member, path)
+        else:
+            with tempfile.SpooledTemporaryFile(max_size=INCREMENTAL_SPOOL_SIZE, dir=os.path.dirname(path)) as spool:
+                sha = hashlib.sha256()
+                for chunk in iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    spool.write(chunk)
+                if sha.hexdigest() == digest:
+                    self.files_skipped += 1
+                    self.bytes_skipped += member.size
+                    if os.stat(path).st_mode & 0o7777 != member.mode:
+                        os.chmod(path, member.mode)
+                else:
+                    spool.seek(0)
+                    digest = self._write_file(spool, member, path)
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, digest]
+
+    def _write_file(self, data, member, path):
+        import hashlib
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{0}.faas-tmp'.format(path)
+        sha = hashlib.sha256()
+        with open(tmp, 'wb') as f:
+            for chunk in iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha.update(chunk)
+                f.write(chunk)
+        os.chmod(tmp, member.mode)
+        os.utime(tmp, (member.mtime, member.mtime))
+        os.replace(tmp, path)
+        self.files_written += 1
+        self.bytes_written += member.size
+        return sha.hexdigest()
+
+
+class SharedCache:
+    """
+    Host-wide cache shared by every installation:
+      archives/  one archive per version, named after its SHA-256 (downloaded once per host)
+      objects/   content-addressed store of the extracted files, installations are hardlinked to it
+    The cache is kept under a size limit by evicting the least recently used archives, then the unused objects.
+    """
+
+    def __init__(self, path, max_size, vprint=print):
+        self.path = path
+        self.max_size = max_size
+        self.vprint = vprint
+        self.archives_path = os.path.join(path, 'archives')
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index.json')
+        os.makedirs(self.archives_path, exist_ok=True)
+        os.makedirs(self.objects_path, exist_ok=True)
+
+    def lock(self, name='.lock'):
+        return file_lock(os.path.join(self.path, name))
+
+    def download_lock(self, version):
+        return self.lock('.download-{0}.lock'.format(version))
+
+    def download_path(self, version):
+        return os.path.join(self.archives_path, 'download-{0}.tar.xz'.format(version))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'archives': {}, 'stats': {}}
+
+    def _save_index(self, index):
+        tmp = '{0}.{1}.tmp'.format(self.index_path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _count(index, stat, value=1):
+        index['stats'][stat] = index['stats'].get(stat, 0) + value
+
+    def get_archive(self, version):
+        with self.lock():
+            index = self._load_index()
+            entry = index['archives'].get(version)
+            if entry and os.path.isfile(os.path.join(self.archives_path, entry['file'])):
+                entry['last-used'] = time.time()
+                self._count(index, 'archive-hits')
+                self.vprint('Archive of version', version, 'found in the shared cache')
+            else:
+                entry = None
+                self._count(index, 'archive-misses')
+            self._save_index(index)
+        return os.path.join(self.archives_path, entry['file']) if entry else None
+
+    def add_archive(self, version, path, sha256):
+        name = 'factorio-{0}-{1}.tar.xz'.format(version, sha256)
+        os.replace(path, os.path.join(self.archives_path, name))
+        with self.lock():
+            index = self._load_index()
+            index['archives'][version] = {'file': name, 'sha256': sha256, 'last-used': time.time()}
+            self._evict(index, version)
+            self._save_index(index)
+
+    def _object_path(self, digest, mode):
+        return os.path.join(self.objects_path, digest[:2], '{0}-{1:o}'.format(digest, mode & 0o7777))
+
+    def _file_list_path(self, version):
+        return os.path.join(self.archives_path, 'files-{0}.json'.format(version))
+
+    def _ingest(self, version, archive):
+        """Decompress the archive once and add its files to the store"""
+        import tarfile
+        self.vprint('Adding version', version, 'to the object store')
+        files, stored = [], {}
+        with tarfile.open(archive, mode='r|xz') as tar:
+            for member in tar:
+                name = strip_archive_component(member.name)
+                if name is None:
+                    continue
+                if member.isdir():
+                    files.append([name, 'dir', None, member.mode, member.mtime])
+                elif member.issym():
+                    files.append([name, 'sym', member.linkname, member.mode, member.mtime])
+                elif member.islnk():
+                    # Both names are linked to the same object
+                    target = stored.get(strip_archive_component(member.linkname))
+                    if target is None:
+                        raise ExtractionError('{0} is a link to {1}, not a file of the archive'
+                                              .format(member.name, member.linkname))
+                    files.append([name] + target)
+                elif member.isfile():
+                    stored[name] = ['file', self._store(tar.extractfile(member), member), member.mode, member.mtime]
+                    files.append([name] + stored[name])
+        tmp = '{0}.tmp'.format(self._file_list_path(version))
+        with open(tmp, 'w') as f:
+            json.dump(files, f)
+        os.replace(tmp, self._file_list_path(version))
+        return files
+
+    def _store(self, data, member):
+        import hashlib
+        tmp = os.path.join(self.objects_path, 'tmp-{0}'.format(threading.get_ident()))
+        sha = hashlib.sha256()
+        with open(tmp, 'wb') as f:
+            for chunk in iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha.update(chunk)
+                f.write(chunk)
+        digest = sha.hexdigest()
+        path = self._object_path(digest, member.mode)
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp, member.mode)
+            os.utime(tmp, (member.mtime, member.mtime))
+            os.replace(tmp, path)
+        return digest
+
+    def _file_list(self, version):
+        try:
+            with open(self._file_list_path(version)) as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for name, kind, digest, mode, _ in files:
+            if kind == 'file' and not os.path.exists(self._object_path(digest, mode)):
+                return None
+        return files
+
+    def install(self, version, destination):
+        with self.lock():
+            index = self._load_index()
+            files = self._file_list(version)
+            if files is None:
+                self._count(index, 'install-misses')
+                files = self._ingest(version, os.path.join(self.archives_path, index['archives'][version]['file']))
+            else:
+                self._count(index, 'install-hits')
+            installer = StoreInstaller(destination, self.vprint)
+            installer.apply_files(files, self._object_path)
+            # The new objects count in the size limit, the ones no installation links to anymore can go
+            self._evict(index, version)
+            self._save_index(index)
+        return installer
+
+    def _evict(self, index, keep):
+        objects = list(self._objects())
+        size = sum(st.st_size for _, st in objects)
+        size += sum(os.path.getsize(os.path.join(self.archives_path, name)) for name in os.listdir(self.archives_path))
+        archives = sorted([item for item in index['archives'].items() if item[0] != keep],
+                          key=lambda item: item[1]['last-used'])
+        while size > self.max_size and archives:
+            version, entry = archives.pop(0)
+            self.vprint('Evicting archive', entry['file'], 'from the shared cache')
+            for path in (os.path.join(self.archives_path, entry['file']), self._file_list_path(version)):
+                if os.path.exists(path):
+                    size -= os.path.getsize(path)
+                    os.remove(path)
+            del index['archives'][version]
+        for path, st in sorted(objects, key=lambda item: item[1].st_atime):
+            if size <= self.max_size:
+                break
+            if st.st_nlink == 1:
+                os.remove(path)
+                size -= st.st_size
+
+    def _objects(self):
+        for root, _, names in os.walk(self.objects_path):
+            for name in names:
+                path = os.path.join(root, name)
+                yield path, os.lstat(path)
+
+    def stats(self):
+        with self.lock():
+            index = self._load_index()
+            objects = list(self._objects())
+        stats = index['stats']
+        rows = []
+        for kind in ('archive', 'install'):
+            hits, misses = stats.get(kind + '-hits', 0), stats.get(kind + '-misses', 0)
+            rate = '{0:.1f}%'.format(100.0 * hits / (hits + misses)) if hits + misses else '-'
+            rows.append(('{0} hit rate'.format(kind.capitalize()),
+                         '{0} ({1} hits, {2} misses)'.format(rate, hits, misses)))
+        archives_size = sum(os.path.getsize(os.path.join(self.archives_path, entry['file']))
+                            for entry in index['archives'].values()
+                            if os.path.isfile(os.path.join(self.archives_path, entry['file'])))
+        objects_size = sum(st.st_size for _, st in objects)
+        saved = sum(st.st_size * max(0, st.st_nlink - 2) for _, st in objects)
+        rows.append(('Cached versions', ', '.join(sorted(index['archives'], key=str_to_version)) or '-'))
+        rows.append(('Archives size', format_size(archives_size)))
+        rows.append(('Objects', '{0} ({1})'.format(len(objects), format_size(objects_size))))
+        rows.append(('Space saved by links', format_size(saved)))
+        return rows
+
+
+class StoreInstaller(IncrementalInstaller):
+    """Materialize a version from the object store with hardlinks (or reflinks/copies across filesystems)"""
+
+    def __str__(self):
+        return 'Install from shared cache: {0} files linked ({1} bytes), {2} unchanged ({3} bytes), {4} removed'.format(
+            self.files_written, self.bytes_written, self.files_skipped, self.bytes_skipped, self.files_removed)
+
+    def apply_files(self, files, object_path):
+        previous = self._load_manifest()
+        manifest = {}
+        for name, kind, target, mode, mtime in files:
+            path = os.path.join(self.destination, name)
+            if kind == 'dir':
+                os.makedirs(path, exist_ok=True)
+            elif kind == 'sym':
+                self._apply_symlink(target, path)
+            else:
+                source = object_path(target, mode)
+                self._link(source, path)
+                st = os.stat(path)
+                manifest[name] = [st.st_size, st.st_mtime_ns, target]
+        for name in set(previous) - set(manifest):
+            path = os.path.join(self.destination, name)
+            if os.path.lexists(path):
+                self.vprint('Removing', path)
+                os.remove(path)
+                self.files_removed += 1
+        self._save_manifest(manifest)
+
+    def _link(self, source, path):
+        import shutil
+        import subprocess
+        size = os.path.getsize(source)
+        if os.path.exists(path) and os.path.samefile(source, path):
+            self.files_skipped += 1
+            self.bytes_skipped += size
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{0}.faas-tmp'.format(path)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            sub = subprocess.run(['cp', '--reflink=auto', '--preserve=mode,timestamps', source, tmp],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if sub.returncode != 0:
+                shutil.copy2(source, tmp)
+        os.replace(tmp, path)
+        self.files_written += 1
+        self.bytes_written += size
+
+
+def hardlink_target(member, destination):
+    """Path of the file a hardlink member of the archive points to"""
+    target = strip_archive_component(member.linkname)
+    if target is None:
+        raise ExtractionError('{0} is a link to {1}, outside of the archive'.format(member.name, member.linkname))
+    return os.path.join(destination, target)
+
+
+def write_hardlink(target, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{0}.faas-tmp'.format(path)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(target, tmp)
+    os.replace(tmp, path)
+
+
+def zip_header_size(data):
+    """Size of the zip local file header at the start of data"""
+    if len(data) < 30:
+        return None
+    return 30 + int.from_bytes(data[26:28], 'little') + int.from_bytes(data[28:30], 'little')
+
+
+class SnapshotResult(namedtuple('SnapshotResult', 'name size chunks new_chunks new_size stored elapsed')):
+
+    def __str__(self):
+        dedup = 100.0 * (1 - self.new_size / self.size) if self.size else 100.0
+        return 'Snapshot {0}: {1} in {2} chunks, {3} new ({4} stored), {5:.1f}% deduplicated in {6:.2f}s'.format(
+            self.name, format_size(self.size), self.chunks, self.new_chunks, format_size(self.stored), dedup,
+            self.elapsed)
+
+
+class SnapshotStore:
+    """
+    Deduplicated snapshots of the save files:
+      chunks/     content-defined chunks of the saves, named after their SHA-256 and compressed when it helps
+      snapshots/  one manifest per snapshot, listing its chunks
+    Consecutive saves share most of their chunks, so a snapshot only writes the parts of the save that changed.
+    """
+
+    def __init__(self, path, workers=4, vprint=print):
+        self.path = path
+        self.workers = workers
+        self.vprint = vprint
+        self.chunks_path = os.path.join(path, 'chunks')
+        self.snapshots_path = os.path.join(path, 'snapshots')
+        os.makedirs(self.chunks_path, exist_ok=True)
+        os.makedirs(self.snapshots_path, exist_ok=True)
+
+    def lock(self):
+        return file_lock(os.path.join(self.path, '.lock'))
+
+    @staticmethod
+    def iter_chunks(f):
+        """
+        Cut before a zip entry header once the chunk has at least SNAPSHOT_MIN_CHUNK bytes, and right after it:
+        the header holds the modification time of the entry, so it would change the chunk of an unchanged entry
+        """
+        pending = b''
+        eof = False
+        while True:
+            if not eof and len(pending) < 2 * SNAPSHOT_MAX_CHUNK:
+                data = f.read(SNAPSHOT_MAX_CHUNK)
+                eof = not data
+                pending += data
+            header = zip_header_size(pending) if pending.startswith(SNAPSHOT_ANCHOR) else None
+            cut = pending.find(SNAPSHOT_ANCHOR, SNAPSHOT_MIN_CHUNK, SNAPSHOT_MAX_CHUNK)
+            if header is not None and header <= len(pending):
+                cut = header
+            elif cut == -1 and len(pending) >= SNAPSHOT_MAX_CHUNK:
+                cut = SNAPSHOT_MAX_CHUNK
+            elif cut == -1 and eof:
+                if pending:
+                    yield pending
+                return
+            if cut != -1:
+                yield pending[:cut]
+                pending = pending[cut:]
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_path, digest[:2], digest)
+
+    def _find_chunk(self, digest):
+        """Returns the path of the stored chunk and whether it is compressed, None if it is not stored"""
+        path = self._chunk_path(digest)
+        for candidate, compressed in ((path + '.z', True), (path, False)):
+            if os.path.isfile(candidate):
+                return candidate, compressed
+        return None
+
+    def _write_chunk(self, digest, data):
+        """Runs on the worker pool, returns the number of bytes written"""
+        import zlib
+        compressed = zlib.compress(data, 1)
+        path = self._chunk_path(digest)
+        if len(compressed) < len(data):
+            path, data = path + '.z', compressed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def snapshot(self, source, prefix, version=None):
+        import base64
+        import hashlib
+        from concurrent.futures import ThreadPoolExecutor
+        start = time.time()
+        with self.lock():
+            name = base = '{0}-{1}'.format(prefix, time.strftime('%Y%m%d-%H%M%S'))
+            count = 1
+            while os.path.exists(self._manifest_path(name)):
+                count += 1
+                name = '{0}-{1}'.format(base, count)
+            chunks, seen, new_size, stored, pending = [], set(), 0, [], []
+            sha = hashlib.sha256()
+            st = os.stat(source)
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool, open(source, 'rb') as f:
+                    for data in self.iter_chunks(f):
+                        sha.update(data)
+                        if len(data) <= SNAPSHOT_INLINE_CHUNK:
+                            chunks.append('b64:' + base64.b64encode(data).decode())
+                            continue
+                        digest = hashlib.sha256(data).hexdigest()
+                        if digest not in seen and self._find_chunk(digest) is None:
+                            new_size += len(data)
+                            pending.append(pool.submit(self._write_chunk, digest, data))
+                            # Bound the memory used by the chunks waiting for their compression
+                            while len(pending) > 2 * self.workers:
+                                stored.append(pending.pop(0).result())
+                        chunks.append(digest)
+                        seen.add(digest)
+                    stored += [future.result() for future in pending]
+                after = os.stat(source)
+                if (after.st_mtime_ns, after.st_size) != (st.st_mtime_ns, st.st_size):
+                    raise SaveChangedError('the save file changed during the snapshot')
+            except BaseException:
+                # The chunks already written are only referenced by this snapshot
+                self._collect_chunks()
+                raise
+            manifest = {'name': name, 'server': prefix, 'created': start, 'source': source, 'version': version,
+                        'size': st.st_size, 'sha256': sha.hexdigest(), 'chunks': chunks}
+            tmp = '{0}.tmp'.format(self._manifest_path(name))
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp, self._manifest_path(name))
+        new_chunks = len(stored)
+        return SnapshotResult(name, st.st_size, len(chunks), new_chunks, new_size, sum(stored), time.time() - start)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.snapshots_path, '{0}.json'.format(name))
+
+    def manifests(self, prefix=None):
+        """Every snapshot (or the snapshots of a server), oldest first"""
+        manifests = []
+        for filename in os.listdir(self.snapshots_path):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.snapshots_path, filename)) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if prefix is None or manifest.get('server') == prefix:
+                manifests.append(manifest)
+        return sorted(manifests, key=lambda x: x['created'])
+
+    def find(self, name, prefix):
+        manifests = self.manifests(prefix if name == 'latest' else None)
+        if name == 'latest':
+            return manifests[-1] if manifests else None
+        return next((manifest for manifest in manifests if manifest['name'] == name), None)
+
+    def restore(self, manifest, destination):
+        """Rebuild the save next to the destination, check it, then replace the destination atomically"""
+        import zlib
+        import base64
+        import hashlib
+        tmp = '{0}.faas-restore'.format(destination)
+        sha = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as f:
+                for digest in manifest['chunks']:
+                    if digest.startswith('b64:'):
+                        data = base64.b64decode(digest[4:])
+                        sha.update(data)
+                        f.write(data)
+                        continue
+                    found = self._find_chunk(digest)
+                    if found is None:
+                        raise ValueError('chunk {0} is missing'.format(digest))
+                    with open(found[0], 'rb') as chunk:
+                        data = chunk.read()
+                    if found[1]:
+                        data = zlib.decompress(data)
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        raise ValueError('chunk {0} is corrupted'.format(digest))
+                    sha.update(data)
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if sha.hexdigest() != manifest['sha256']:
+                raise ValueError('the SHA-256 of the restored save does not match the snapshot')
+            if os.path.exists(destination):
+                # The server does not run as root, it must still be able to overwrite its save
+                st = os.stat(destination)
+                os.chown(tmp, st.st_uid, st.st_gid)
+                os.chmod(tmp, st.st_mode & 0o7777)
+            os.replace(tmp, destination)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def prune(self, prefix, keep, max_age=0):
+        """Apply the retention policy to the snapshots of a server, then remove the unused chunks"""
+        with self.lock():
+            manifests = self.manifests(prefix)
+            removed = manifests[:-keep]
+            if max_age:
+                removed += [m for m in manifests[-keep:-1] if time.time() - m['created'] > max_age]
+            for manifest in removed:
+                os.remove(self._manifest_path(manifest['name']))
+            if removed:
+                self._collect_chunks()
+        return [manifest['name'] for manifest in removed]
+
+    def _collect_chunks(self):
+        used = set()
+        for manifest in self.manifests():
+            used.update(manifest['chunks'])
+        for directory in os.listdir(self.chunks_path):
+            for filename in os.listdir(os.path.join(self.chunks_path, directory)):
+                if filename.split('.')[0] not in used:
+                    os.remove(os.path.join(self.chunks_path, directory, filename))
+
+
+class SaveSync:
+    """
+    Keep the saves directory of a server in sync with its copy in memory (ram-saves).
+    Each save is copied toward its newer side, with its mtime, so an unchanged save is never copied again.
+    The copy is written next to the destination, fsynced, then renamed over it: a crash during a sync
+    never leaves a truncated save. A save modified during its copy is skipped until the next sync.
+    """
+
+    def __init__(self, disk_path, memory_path, vprint=print):
+        self.disk_path = disk_path
+        self.memory_path = memory_path
+        self.vprint = vprint
+
+    @staticmethod
+    def _saves(path):
+        saves = {}
+        for entry in os.scandir(path):
+            if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                saves[entry.name] = entry.stat(follow_symlinks=False).st_mtime_ns
+        return saves
+
+    def sync(self):
+        """Returns the names of the saves written to the disk and to memory"""
+        on_disk = self._saves(self.disk_path)
+        in_memory = self._saves(self.memory_path)
+        to_disk, to_memory = [], []
+        for name in sorted(set(on_disk) | set(in_memory)):
+            disk_mtime, memory_mtime = on_disk.get(name, -1), in_memory.get(name, -1)
+            if memory_mtime > disk_mtime:
+                if self._copy(os.path.join(self.memory_path, name), os.path.join(self.disk_path, name)):
+                    to_disk.append(name)
+            elif disk_mtime > memory_mtime:
+                if self._copy(os.path.join(self.disk_path, name), os.path.join(self.memory_path, name)):
+                    to_memory.append(name)
+        return to_disk, to_memory
+
+    def _copy(self, source, destination):
+        import shutil
+        directory, name = os.path.split(destination)
+        tmp = os.path.join(directory, '.{0}.faas-sync'.format(name))
+        try:
+            before = os.stat(source)
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            after = os.stat(source)
+            if (after.st_mtime_ns, after.st_size) != (before.st_mtime_ns, before.st_size):
+                self.vprint('{0} is being written, it is synced next time'.format(source))
+                return False
+            os.utime(tmp, ns=(before.st_atime_ns, before.st_mtime_ns))
+            os.chmod(tmp, before.st_mode & 0o7777)
+            if os.geteuid() == 0:
+                # Synced as root by the unit: the server must still be able to overwrite its saves
+                owner = os.stat(destination) if os.path.exists(destination) else before
+                os.chown(tmp, owner.st_uid, owner.st_gid)
+            os.replace(tmp, destination)
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class ModSync:
+    """
+    Keep the mods of a server in sync with the mod portal. The releases compatible with the game version
+    are resolved with the portal API, downloaded concurrently into a cache shared by every server (named
+    after their SHA-1, which is verified), then linked into the mods directory when they changed.
+    """
+
+    Release = namedtuple('Release', 'name version file_name download_url sha1')
+
+    def __init__(self, portal_url, cache_path, credentials=None, workers=8, vprint=print, http=None):
+        self.portal_url = portal_url
+        self.cache_path = cache_path
+        self.credentials = credentials
+        self.workers = workers
+        self.vprint = vprint
+        self.http = http or HttpClient()
+
+    @staticmethod
+    def read_manifest(path):
+        """(name, version) of the enabled mods of a mod-list.json, the version is optional and pins the mod"""
+        with open(path) as f:
+            data = json.load(f)
+        return [(mod['name'], mod.get('version')) for mod in data.get('mods', [])
+                if mod.get('enabled', True) and mod['name'] not in BUILTIN_MODS]
+
+    def _map(self, function, items):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(function, items))
+
+    def resolve(self, mods, factorio_version):
+        """Latest release of each mod for the major.minor of factorio_version (or its pinned version)"""
+        branch = '.'.join(str(number) for number in factorio_version[:2])
+        releases = self._map(lambda mod: self._resolve(mod[0], mod[1], branch), mods)
+        return [release for release in releases if release is not None]
+
+    def _resolve(self, name, pinned, branch):
+        from urllib.parse import quote
+        url = '{0}/api/mods/{1}/full'.format(self.portal_url, quote(name))
+        status, _, body, _ = self.http.get(url)
+        if status != 200:
+            print('Mod "{0}" not found on the mod portal (HTTP {1}), the installed one is kept'.format(name, status),
+                  file=sys.stderr)
+            return None
+        candidates = []
+        for release in json.loads(body.decode()).get('releases', []):
+            if pinned and release['version'] == pinned:
+                candidates = [release]
+                break
+            if not pinned and release.get('info_json', {}).get('factorio_version') == branch:
+                candidates.append(release)
+        if not candidates:
+            self.vprint('No release of {0} for Factorio {1}, the installed one is kept'.format(name, pinned or branch))
+            return None
+        release = max(candidates, key=lambda x: str_to_version(x['version']))
+        return self.Release(name, release['version'], release['file_name'], release['download_url'], release['sha1'])
+
+    def _cache_file(self, release):
+        return os.path.join(self.cache_path, '{0}-{1}'.format(release.sha1, release.file_name))
+
+    def download(self, releases):
+        """Download the releases missing from the cache"""
+        missing = [release for release in releases if not os.path.isfile(self._cache_file(release))]
+        if not missing:
+            return
+        if not self.credentials:
+            raise ValueError('no mod portal credentials (username and token in [MODS], or player-data.json)')
+        os.makedirs(self.cache_path, exist_ok=True)
+        start = time.time()
+        sizes = self._map(self._download, missing)
+        self.vprint('{0} mods downloaded ({1}) in {2:.2f}s'.format(len(missing), format_size(sum(sizes)),
+                                                                  time.time() - start))
+
+    def _download(self, release):
+        """Stream a release to the cache, its SHA-1 is computed on the way"""
+        import hashlib
+        from urllib.parse import urlencode
+        url = '{0}{1}?{2}'.format(self.portal_url, release.download_url,
+                                  urlencode({'username': self.credentials[0], 'token': self.credentials[1]}))
+        path = self._cache_file(release)
+        tmp = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        sha = hashlib.sha1()
+        size = 0
+        try:
+            with self.http.open(url, raise_errors=False) as fs:
+                if fs.status != 200:
+                    raise IOError('unable to download {0} (HTTP {1})'.format(release.file_name, fs.status))
+                with open(tmp, 'wb') as f:
+                    for chunk in iter(lambda: fs.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        size += len(chunk)
+            if sha.hexdigest() != release.sha1:
+                raise ValueError('SHA-1 mismatch for {0}'.format(release.file_name))
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return size
+
+    @staticmethod
+    def changes(releases, mods_path):
+        return [release for release in releases if not os.path.isfile(os.path.join(mods_path, release.file_name))]
+
+    def install(self, releases, mods_path):
+        """Link the new releases into the mods directory and remove the other versions of these mods"""
+        import shutil
+        os.makedirs(mods_path, exist_ok=True)
+        installed, removed = [], []
+        for release in self.changes(releases, mods_path):
+            path = os.path.join(mods_path, release.file_name)
+            tmp = '{0}.faas-tmp'.format(path)
+            try:
+                os.link(self._cache_file(release), tmp)
+            except OSError:
+                shutil.copy2(self._cache_file(release), tmp)
+            os.replace(tmp, path)
+            installed.append(release.file_name)
+        for release in releases:
+            pattern = re.compile(r'^{0}_\d+\.\d+\.\d+\.zip$'.format(re.escape(release.name)))
+            for filename in os.listdir(mods_path):
+                if filename != release.file_name and pattern.match(filename):
+                    os.remove(os.path.join(mods_path, filename))
+                    removed.append(filename)
+        return installed, removed
+
+
+class DownloadResult(namedtuple('DownloadResult', 'path filename size sha256 downloaded resumed elapsed')):
+
+    def __str__(self):
+        rate = self.downloaded / self.elapsed if self.elapsed > 0 else 0
+        return '{0}: {1} bytes ({2} downloaded, {3} resumed) in {4:.2f}s - {5:.2f} MB/s - SHA-256 {6}'.format(
+            self.filename, self.size, self.downloaded, self.resumed, self.elapsed, rate / 1024 / 1024, self.sha256)
+
+
+class ArchiveDownloader:
+    """
+    Download a file with parallel HTTP Range requests.
+    Progress is persisted next to the partial file so an interrupted download is resumed by the next run.
+    The SHA-256 is computed while the segments are being written, following the contiguous downloaded prefix.
+    """
+
+    def __init__(self, url, path, segments=4, vprint=print, http=None):
+        self.url = url
+        self.path = path
+        self.part_path = '{0}.part'.format(path)
+        self.state_path = '{0}.state'.format(path)
+        self.segments = max(1, segments)
+        self.vprint = vprint
+        self.http = http or HttpClient()
+        self._cond = threading.Condition()
+        self._state = None
+        self._downloaded = 0
+        self._failed = False
+
+    def download(self):
+        from urllib.parse import urlparse
+        start = time.time()
+        size, final_url = self._probe()
+        filename = os.path.basename(urlparse(final_url).path)
+        if size is None:
+            self.vprint('Server does not support range requests, downloading in a single stream')
+            sha256 = self._download_single(final_url)
+            size = os.path.getsize(self.part_path)
+            resumed = 0
+        else:
+            self._load_state(size)
+            resumed = sum(seg[2] for seg in self._state['segments'])
+            if resumed:
+                self.vprint('Resuming previous download ({0}/{1} bytes already there)'.format(resumed, size))
+            sha256 = self._download_segments(final_url, size)
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return DownloadResult(self.path, filename, size, sha256, self._downloaded, resumed, time.time() - start)
+
+    def _probe(self):
+        """Returns the size of the file (None if ranges are not supported) and the url after redirections"""
+        with self.http.open(self.url, {'Range': 'bytes=0-0'}) as fs:
+            content_range = fs.headers.get('Content-Range', '')
+            res = re.match(r'bytes\s+\d+-\d+/(\d+)', content_range)
+            if fs.status == 206 and res:
+                # Read the single byte so the connection can be reused by a segment
+                fs.read()
+                return int(res.group(1)), fs.geturl()
+            return None, fs.geturl()
+
+    def _download_single(self, url):
+        import hashlib
+        sha = hashlib.sha256()
+        with self.http.open(url) as fs:
+            with open(self.part_path, 'wb') as f:
+                for chunk in iter(lambda: fs.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    sha.update(chunk)
+                    self._downloaded += len(chunk)
+        return sha.hexdigest()
+
+    def _load_state(self, size):
+        state = None
+        if os.path.isfile(self.state_path) and os.path.isfile(self.part_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+            if state and (state.get('url') != self.url or state.get('size') != size
+                          or os.path.getsize(self.part_path) != size):
+                self.vprint('Partial download does not match this archive, starting from scratch')
+                state = None
+        if state is None:
+            step = -(-size // self.segments)
+            segments = [[begin, min(begin + step, size), 0] for begin in range(0, size, step)]
+            state = {'url': self.url, 'size': size, 'segments': segments}
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size)
+        self._state = state
+        self._save_state()
+
+    def _save_state(self):
+        tmp = '{0}.tmp'.format(self.state_path)
+        with open(tmp, 'w') as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self.state_path)
+
+    def _download_segments(self, url, size):
+        from concurrent.futures import ThreadPoolExecutor
+        fd = os.open(self.part_path, os.O_RDWR)
+        try:
+            pending = [seg for seg in self._state['segments'] if seg[0] + seg[2] < seg[1]]
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+                futures = [pool.submit(self._download_segment, url, fd, seg) for seg in pending]
+                sha256 = self._hash_frontier(fd, size)
+                for future in futures:
+                    future.result()
+            return sha256
+        finally:
+            os.close(fd)
+            with self._cond:
+                self._save_state()
+
+    def _download_segment(self, url, fd, seg):
+        attempt = 0
+        unsaved = 0
+        while True:
+            offset = seg[0] + seg[2]
+            if offset >= seg[1]:
+                return
+            headers = {'Range': 'bytes={0}-{1}'.format(offset, seg[1] - 1)}
+            try:
+                with self.http.open(url, headers) as fs:
+                    if fs.status != 206:
+                        raise IOError('Range request not honoured (HTTP {0})'.format(fs.status))
+                    for chunk in iter(lambda: fs.read(min(DOWNLOAD_CHUNK_SIZE, seg[1] - seg[0] - seg[2])), b''):
+                        os.pwrite(fd, chunk, seg[0] + seg[2])
+                        unsaved += len(chunk)
+                        with self._cond:
+                            seg[2] += len(chunk)
+                            self._downloaded += len(chunk)
+                            if unsaved >= DOWNLOAD_STATE_INTERVAL:
+                                self._save_state()
+                                unsaved = 0
+                            self._cond.notify_all()
+                        if seg[0] + seg[2] >= seg[1]:
+                            break
+                if seg[0] + seg[2] < seg[1]:
+                    raise IOError('connection closed after {0} bytes'.format(seg[2]))
+            except Exception as err:
+                attempt += 1
+                if attempt >= DOWNLOAD_RETRIES:
+                    with self._cond:
+                        self._failed = True
+                        self._cond.notify_all()
+                    raise
+                self.vprint('Segment {0}-{1} interrupted ({2}), retrying'.format(seg[0], seg[1], str(err)))
+
+    def _frontier(self):
+        for begin, end, done in self._state['segments']:
+            if begin + done < end:
+                return begin + done
+        return self._state['size']
+
+    def _hash_frontier(self, fd, size):
+        import hashlib
+        sha = hashlib.sha256()
+        hashed = 0
+        while hashed < size:
+            with self._cond:
+                while self._frontier() <= hashed and not self._failed:
+                    self._cond.wait()
+                if self._failed:
+                    return None
+                frontier = self._frontier()
+            while hashed < frontier:
+                chunk = os.pread(fd, min(DOWNLOAD_CHUNK_SIZE * 16, frontier - hashed), hashed)
+                sha.update(chunk)
+                hashed += len(chunk)
+        return sha.hexdigest()
+
+
+class FactorioVersionPageParser:
+    """
+    Collect the versions (and their download links) of a download page.
+    The latest version is tracked while parsing, the full list is only sorted once when it is requested.
+    With latest_only, the parser is done as soon as the first download link is found (the pages list
+    the most recent version first), so the caller can stop feeding it.
+    html.parser is only imported when a page is actually parsed, the callbacks of a plain HTMLParser
+    are bound to this object instead of subclassing it.
+    """
+
+    Version = namedtuple('Version', 'number path')
+
+    def __init__(self, latest_only=False):
+        self.latest_only = latest_only
+        self.done = False
         self.current_version = None
+        self._versions = []
+        self._sorted = True
+        self._latest = None
         self._in_h3 = False
-        super().__init__()
+        self._html = None
+
+    def _get_html_parser(self):
+        if self._html is None:
+            from html.parser import HTMLParser
+            self._html = HTMLParser()
+            self._html.handle_starttag = self.handle_starttag
+            self._html.handle_endtag = self.handle_endtag
+            self._html.handle_data = self.handle_data
+        return self._html
+
+    @classmethod
+    def from_versions(cls, versions):
+        parser = cls()
+        for number, path in versions:
+            parser.add_version(cls.Version(number=str_to_version(number), path=path))
+        return parser
+
+    def feed(self, data):
+        if not self.done:
+            self._get_html_parser().feed(data)
+
+    def close(self):
+        if self._html is not None:
+            self._html.close()
 
     def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
         if tag == 'h3':
             self._in_h3 = True
         elif tag == 'a' and self.current_version is not None:
@@ -496,11 +3636,18 @@ class FactorioVersionPageParser(HTMLParser):
     def get_download_link(self, attrs):
         for attr in attrs:
             if attr[0] == 'href':
-                self.available_version.append(self.Version(number=self.current_version, path=attr[1]))
-                self.available_version = sorted(self.available_version, key=lambda x: x.number, reverse=True)
+                self.add_version(self.Version(number=self.current_version, path=attr[1]))
                 self.current_version = None
+                self.done = self.latest_only
                 break
 
+    def add_version(self, version):
+        if self._latest is None or version.number > self._latest.number:
+            self._latest = version
+        if self._versions and version.number > self._versions[-1].number:
+            self._sorted = False
+        self._versions.append(version)
+
     def error(self, message):
         pass
 
@@ -508,22 +3655,28 @@ class FactorioVersionPageParser(HTMLParser):
         if not self.available_version:
             return 'No available version found :('
         ls = ['Latest version:',
-              '{0} [{1}]'.format(self.available_version[0].number.vstring, self.available_version[0].path)]
-        if len(self.available_version) > 1:
+              '{0} [{1}]'.format(self.latest_version.number.vstring, self.latest_version.path)]
+        others = [v for v in self.available_version if v is not self.latest_version]
+        if others:
             ls.append('-- Other versions --')
-            for v in self.available_version[1:]:
+            for v in others:
                 ls.append('{0} [{1}]'.format(v.number.vstring, v.path))
         return '\n'.join(ls)
 
+    @property
+    def available_version(self):
+        if not self._sorted:
+            self._versions.sort(key=lambda x: x.number, reverse=True)
+            self._sorted = True
+        return self._versions
+
     @property
     def latest_version(self):
-        if not self.available_version:
-            return None
-        return self.available_version[0]
+        return self._latest
 
     @property
     def version_found(self):
-        return len(self.available_version) > 0
+        return self._latest is not None
 
 
 if __name__ == "__main__":
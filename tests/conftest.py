@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import faas  # noqa: E402
+
+FAKE_BINARY = '#!/bin/sh\necho "Version: {0} (build 1, linux64, headless)"\n'
+
+
+def write_binary(factorio_path, version):
+    """Fake factorio binary answering --version"""
+    path = os.path.join(factorio_path, 'bin', 'x64', 'factorio')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(FAKE_BINARY.format(version))
+    os.chmod(path, 0o755)
+    return path
+
+
+@pytest.fixture
+def make_commands(tmp_path, monkeypatch):
+    """FactorioCommands reading a config file written in tmp_path"""
+    def make(config, *args):
+        path = tmp_path / 'config.ini'
+        path.write_text(config.format(tmp=tmp_path))
+        monkeypatch.setattr(sys, 'argv', ['faas.py', '-C', str(path)] + list(args or ['-u']))
+        return faas.FactorioCommands(faas.init_args_parse())
+    return make
+
+
+def write_archive(path, files, hardlinks=None, mtime=1600000000):
+    """Game archive (tar.xz, under factorio/) with these files (name: content) and hardlinks (name: target)"""
+    import io
+    import tarfile
+    with tarfile.open(path, 'w:xz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo('factorio/{0}'.format(name))
+            info.size, info.mode, info.mtime = len(data), 0o755 if name.startswith('bin/') else 0o644, mtime
+            tar.addfile(info, io.BytesIO(data))
+        for name, target in (hardlinks or {}).items():
+            info = tarfile.TarInfo('factorio/{0}'.format(name))
+            info.type, info.linkname = tarfile.LNKTYPE, 'factorio/{0}'.format(target)
+            info.mode, info.mtime = 0o644, mtime
+            tar.addfile(info)
+    return path
+
+
+PAGE = '<html><body><h3>{0} (stable)</h3><a href="/get/factorio_headless_x64_{0}.tar.xz">Download</a></body></html>'
+
+
+class LocalServer:
+    """
+    Keep-alive HTTP server for the tests: 'files' maps a path to its content (Range requests are supported),
+    'delays' to the seconds to wait before answering, 'abort_after' to a number of bytes after which the
+    connection is closed, once (by the first response longer than that), 'chunked' to the paths sent without a
+    Content-Length.
+    Every request is logged as (client port, path, Range header).
+    """
+
+    def __init__(self):
+        from http.server import ThreadingHTTPServer
+        self.files = {}
+        self.delays = {}
+        self.abort_after = {}
+        self.chunked = set()
+        self.requests = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _handler(self):
+        import re
+        import time
+        from http.server import BaseHTTPRequestHandler
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                server.requests.append((self.client_address[1], path, self.headers.get('Range')))
+                time.sleep(server.delays.get(path, 0))
+                if path not in server.files:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = server.files[path]
+                start, end = 0, len(data) - 1
+                res = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+                self.send_response(206 if res else 200)
+                if res:
+                    start, end = int(res.group(1)), int(res.group(2) or end)
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(data)))
+                body = data[start:end + 1]
+                if path in server.chunked:
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for offset in range(0, len(body), 16384):
+                        chunk = body[offset:offset + 16384]
+                        self.wfile.write('{0:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+                    self.wfile.write(b'0\r\n\r\n')
+                    return
+                self.send_header('Content-Length', str(end + 1 - start))
+                self.end_headers()
+                abort = server.abort_after.get(path)
+                if abort is not None and abort < len(body):
+                    del server.abort_after[path]
+                    self.wfile.write(body[:abort])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        return Handler
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def local_server():
+    server = LocalServer()
+    yield server
+    server.close()
@@ -0,0 +1,34 @@
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/save.zip
+
+[SERVICE]
+service-name = factorio.service
+wait-ready = log
+nice = 5
+
+[server:a]
+factorio-path = {tmp}/a
+
+[server:b]
+factorio-path = {tmp}/b
+wait-ready = port
+"""
+
+
+def test_server_section_overrides_the_service_section(make_commands):
+    fc = make_commands(CONFIG)
+    a, b = fc.for_server('a'), fc.for_server('b')
+    assert fc.config.wait_ready == 'log'
+    assert a.config.wait_ready == 'log'
+    assert b.config.wait_ready == 'port'
+    assert ('Nice', '5') in a.config.service_tuning
+    assert a.config.factorio_path.endswith('/a')
+    assert a.config.save_path == fc.config.save_path
+
+
+def test_service_name_is_not_shared_by_the_servers(make_commands):
+    fc = make_commands(CONFIG)
+    assert fc.config.factorio_service == 'factorio.service'
+    assert fc.for_server('a').config.factorio_service == 'factorio-a.service'
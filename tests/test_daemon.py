@@ -0,0 +1,28 @@
+import faas
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/save.zip
+user = factorio
+"""
+
+
+def test_updater_unit_can_be_enabled(make_commands):
+    unit = make_commands(CONFIG).render_updater_service()
+    assert '--daemon -C ' in unit
+    assert unit.endswith('\n[Install]\nWantedBy=multi-user.target\n')
+
+
+def test_reload_uses_the_client_of_the_new_config(make_commands, monkeypatch):
+    import asyncio
+    fc = make_commands(CONFIG, '--daemon')
+    daemon = faas.UpdateDaemon(fc.vargs, fc)
+    daemon._wakeup = asyncio.Event()
+    previous = daemon.http
+    closed = []
+    monkeypatch.setattr(previous, 'close', lambda: closed.append(True))
+    daemon._reload()
+    assert daemon.fc is not fc
+    assert daemon.http is daemon.fc.http and daemon.http is not previous
+    assert closed == [True]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import faas
+
+SIZE = 1024 * 1024 + 123
+
+
+@pytest.fixture
+def archive(local_server):
+    data = os.urandom(SIZE)
+    local_server.files['/archive.tar.xz'] = data
+    return data
+
+
+def downloader(local_server, tmp_path, segments=4):
+    path = str(tmp_path / 'archive.tar.xz')
+    return faas.ArchiveDownloader(local_server.url + '/archive.tar.xz', path, segments, lambda *args: None)
+
+
+def ranges(local_server):
+    return sorted(rng for _, path, rng in local_server.requests if path == '/archive.tar.xz')
+
+
+def test_segmented_download(local_server, tmp_path, archive):
+    result = downloader(local_server, tmp_path).download()
+    with open(result.path, 'rb') as f:
+        assert f.read() == archive
+    assert result.sha256 == hashlib.sha256(archive).hexdigest()
+    assert (result.size, result.downloaded, result.resumed) == (SIZE, SIZE, 0)
+    assert len(ranges(local_server)) == 5
+    assert not os.path.exists(result.path + '.part') and not os.path.exists(result.path + '.state')
+
+
+def test_interrupted_segment_is_retried(local_server, tmp_path, archive):
+    local_server.abort_after['/archive.tar.xz'] = 100000
+    result = downloader(local_server, tmp_path).download()
+    with open(result.path, 'rb') as f:
+        assert f.read() == archive
+    assert result.sha256 == hashlib.sha256(archive).hexdigest()
+    assert result.downloaded == SIZE
+    # The retry only asks for the end of the interrupted segment
+    assert len(ranges(local_server)) == 6
+    assert any(rng.startswith('bytes={0}-'.format(begin + 100000)) for rng in ranges(local_server)
+               for begin in range(0, SIZE, -(-SIZE // 4)))
+
+
+def test_interrupted_download_is_resumed_by_the_next_run(monkeypatch, local_server, tmp_path, archive):
+    monkeypatch.setattr(faas, 'DOWNLOAD_RETRIES', 1)
+    local_server.abort_after['/archive.tar.xz'] = 100000
+    with pytest.raises(IOError):
+        downloader(local_server, tmp_path).download()
+    path = str(tmp_path / 'archive.tar.xz')
+    assert os.path.isfile(path + '.part') and os.path.isfile(path + '.state')
+    assert not os.path.exists(path)
+
+    del local_server.requests[:]
+    result = downloader(local_server, tmp_path).download()
+    with open(result.path, 'rb') as f:
+        assert f.read() == archive
+    assert result.sha256 == hashlib.sha256(archive).hexdigest()
+    assert result.resumed == SIZE - result.downloaded
+    assert result.downloaded == -(-SIZE // 4) - 100000
+    # Probe, then only the missing end of the interrupted segment
+    assert len(ranges(local_server)) == 2
+
+
+def test_partial_download_of_another_archive_is_restarted(local_server, tmp_path, archive):
+    path = str(tmp_path / 'archive.tar.xz')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'x' * SIZE)
+    with open(path + '.state', 'w') as f:
+        json.dump({'url': 'http://elsewhere/archive.tar.xz', 'size': SIZE, 'segments': [[0, SIZE, SIZE]]}, f)
+    result = downloader(local_server, tmp_path).download()
+    with open(result.path, 'rb') as f:
+        assert f.read() == archive
+    assert (result.resumed, result.sha256) == (0, hashlib.sha256(archive).hexdigest())
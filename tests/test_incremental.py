@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import faas
+from conftest import write_archive
+
+VERSION_1 = {'bin/x64/factorio': b'binary 1', 'data/changed.lua': b'version 1', 'data/kept.lua': b'kept',
+             'data/removed.lua': b'removed upstream'}
+VERSION_2 = {'bin/x64/factorio': b'binary 2', 'data/changed.lua': b'version 2', 'data/kept.lua': b'kept',
+             'data/added.lua': b'added'}
+
+
+def apply(tmp_path, files, hardlinks=None):
+    archive = write_archive(str(tmp_path / 'archive.tar.xz'), files, hardlinks)
+    installer = faas.IncrementalInstaller(str(tmp_path / 'factorio'), lambda *args: None)
+    with open(archive, 'rb') as f:
+        installer.apply(f)
+    return installer
+
+
+def installed(tmp_path):
+    root = tmp_path / 'factorio'
+    return {os.path.relpath(os.path.join(path, name), str(root)): open(os.path.join(path, name), 'rb').read()
+            for path, _, names in os.walk(str(root)) for name in names if name != faas.IncrementalInstaller.MANIFEST}
+
+
+def test_files_removed_upstream_are_deleted(tmp_path):
+    apply(tmp_path, VERSION_1)
+    assert installed(tmp_path) == VERSION_1
+    installer = apply(tmp_path, VERSION_2)
+    assert installed(tmp_path) == VERSION_2
+    assert (installer.files_written, installer.files_skipped, installer.files_removed) == (3, 1, 1)
+    manifest = installer._load_manifest()
+    assert sorted(manifest) == sorted(VERSION_2)
+    st = os.stat(str(tmp_path / 'factorio' / 'data' / 'kept.lua'))
+    assert manifest['data/kept.lua'][:2] == [st.st_size, st.st_mtime_ns]
+
+
+def test_manifest_spares_the_unchanged_files_and_detects_local_changes(tmp_path, monkeypatch):
+    apply(tmp_path, VERSION_1)
+    local = tmp_path / 'factorio' / 'data' / 'kept.lua'
+    local.write_bytes(b'KEPT')
+    read = []
+    installed_digest = faas.IncrementalInstaller._installed_digest
+
+    def digest(installer, path, entry):
+        size, value = installed_digest(installer, path, entry)
+        if not (entry and value == entry[2]):
+            read.append(os.path.basename(path))
+        return size, value
+    monkeypatch.setattr(faas.IncrementalInstaller, '_installed_digest', digest)
+    installer = apply(tmp_path, VERSION_1)
+    # Only the file modified since the manifest is read back, and it is restored
+    assert read == ['kept.lua']
+    assert local.read_bytes() == b'kept'
+    assert (installer.files_written, installer.files_skipped) == (1, 3)
+
+
+def test_hardlinks_of_the_archive(tmp_path):
+    apply(tmp_path, VERSION_1, {'bin/x64/factorio-link': 'bin/x64/factorio'})
+    root = tmp_path / 'factorio'
+    assert os.path.samefile(str(root / 'bin' / 'x64' / 'factorio-link'), str(root / 'bin' / 'x64' / 'factorio'))
+    installer = apply(tmp_path, VERSION_2, {'bin/x64/factorio-link': 'bin/x64/factorio'})
+    assert (root / 'bin' / 'x64' / 'factorio-link').read_bytes() == b'binary 2'
+    assert 'bin/x64/factorio-link' in installer._load_manifest()
+
+
+def test_hardlink_to_a_missing_file_is_rejected(tmp_path):
+    with pytest.raises(faas.ExtractionError):
+        apply(tmp_path, VERSION_1, {'data/link.lua': 'data/unknown.lua'})
+
+
+def test_python_extractor_writes_the_hardlinks(tmp_path):
+    archive = write_archive(str(tmp_path / 'archive.tar.xz'), VERSION_1, {'data/link.lua': 'data/kept.lua'})
+    destination = tmp_path / 'factorio'
+    destination.mkdir()
+    faas.PythonExtractor(2, lambda *args: None).extract_file(archive, str(destination))
+    assert installed(tmp_path) == dict(VERSION_1, **{'data/link.lua': b'kept'})
+    assert os.path.samefile(str(destination / 'data' / 'link.lua'), str(destination / 'data' / 'kept.lua'))
+
+
+def test_shared_cache_links_both_names_to_the_same_object(tmp_path):
+    archive = write_archive(str(tmp_path / 'archive.tar.xz'), VERSION_1, {'data/link.lua': 'data/kept.lua'})
+    cache = faas.SharedCache(str(tmp_path / 'cache'), 1024 * 1024 * 1024, lambda *args: None)
+    cache.add_archive('1.0.0', archive, '0' * 64)
+    cache.install('1.0.0', str(tmp_path / 'factorio'))
+    root = tmp_path / 'factorio'
+    assert installed(tmp_path) == dict(VERSION_1, **{'data/link.lua': b'kept'})
+    assert os.path.samefile(str(root / 'data' / 'link.lua'), str(root / 'data' / 'kept.lua'))
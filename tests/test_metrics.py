@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import faas
+from conftest import write_archive
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {{tmp}}/factorio
+save-path = {{tmp}}/save.zip
+download-mode = stream
+extract-backend = {0}
+
+[WEBSITE]
+baseurl = {1}
+"""
+
+
+@pytest.mark.parametrize('backend', ['python', 'tar'])
+@pytest.mark.parametrize('chunked', [False, True], ids=['content-length', 'chunked'])
+def test_streamed_download_counts_the_bytes_read(make_commands, tmp_path, local_server, backend, chunked):
+    archive = write_archive(str(tmp_path / 'archive.tar.xz'), {'bin/x64/factorio': os.urandom(300 * 1024)})
+    with open(archive, 'rb') as f:
+        local_server.files['/get/1.0.0'] = f.read()
+    if chunked:
+        local_server.chunked.add('/get/1.0.0')
+    fc = make_commands(CONFIG.format(backend, local_server.url))
+    fc.metrics = faas.UpdateMetrics(None, 'factorio.service')
+    fc.latest_version_data = faas.FactorioVersionPageParser.Version(faas.str_to_version('1.0.0'), '/get/1.0.0')
+    os.makedirs(str(tmp_path / 'factorio'))
+    fc.download_extract_archive()
+    assert fc.metrics.download_bytes == os.path.getsize(archive)
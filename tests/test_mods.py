@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {{tmp}}/factorio
+save-path = {{tmp}}/save.zip
+sync-mods = yes
+
+[MODS]
+portal-url = {0}
+username = user
+token = secret
+cache-path = {{tmp}}/cache
+"""
+
+
+def release(version, factorio_version, data):
+    return {'version': version, 'file_name': 'rail_{0}.zip'.format(version),
+            'download_url': '/download/rail/{0}'.format(version), 'sha1': hashlib.sha1(data).hexdigest(),
+            'info_json': {'factorio_version': factorio_version}}
+
+
+@pytest.fixture
+def portal(local_server, tmp_path):
+    """Mod portal stand-in with the releases 1.0.0 (Factorio 1.1), 2.0.0 and 2.1.0 (Factorio 2.0) of a mod"""
+    zips = {version: os.urandom(200 * 1024) for version in ('1.0.0', '2.0.0', '2.1.0')}
+    releases = [release('1.0.0', '1.1', zips['1.0.0']), release('2.0.0', '2.0', zips['2.0.0']),
+                release('2.1.0', '2.0', zips['2.1.0'])]
+    local_server.files['/api/mods/rail/full'] = json.dumps({'name': 'rail', 'releases': releases}).encode()
+    for version, data in zips.items():
+        local_server.files['/download/rail/{0}'.format(version)] = data
+    mods = tmp_path / 'factorio' / 'mods'
+    mods.mkdir(parents=True)
+    (mods / 'mod-list.json').write_text(json.dumps({'mods': [
+        {'name': 'base', 'enabled': True}, {'name': 'rail', 'enabled': True}, {'name': 'off', 'enabled': False}]}))
+    (mods / 'rail_1.0.0.zip').write_bytes(zips['1.0.0'])
+    return zips
+
+
+def test_mods_are_downloaded_and_installed(make_commands, tmp_path, local_server, portal):
+    fc = make_commands(CONFIG.format(local_server.url))
+    releases = fc.prepare_mods((2, 0, 10))
+    assert [(r.name, r.version) for r in releases] == [('rail', '2.1.0')]
+    assert [path for _, path, _ in local_server.requests] == ['/api/mods/rail/full', '/download/rail/2.1.0']
+    cached = os.listdir(str(tmp_path / 'cache'))
+    assert cached == ['{0}-rail_2.1.0.zip'.format(releases[0].sha1)]
+
+    fc.install_mods(releases)
+    mods = tmp_path / 'factorio' / 'mods'
+    assert sorted(os.listdir(str(mods))) == ['mod-list.json', 'rail_2.1.0.zip']
+    assert (mods / 'rail_2.1.0.zip').read_bytes() == portal['2.1.0']
+
+    # Already in the cache: not downloaded again
+    del local_server.requests[:]
+    fc.prepare_mods((2, 0, 10))
+    assert [path for _, path, _ in local_server.requests] == ['/api/mods/rail/full']
+
+
+def test_interrupted_mod_download(make_commands, tmp_path, local_server, portal):
+    local_server.abort_after['/download/rail/2.1.0'] = 50000
+    fc = make_commands(CONFIG.format(local_server.url))
+    with pytest.raises(SystemExit) as err:
+        fc.prepare_mods((2, 0, 10))
+    assert err.value.code == -60
+    assert os.listdir(str(tmp_path / 'cache')) == []
+
+
+def test_mod_with_a_wrong_sha1_is_not_cached(make_commands, tmp_path, local_server, portal):
+    local_server.files['/download/rail/2.1.0'] = b'corrupted'
+    fc = make_commands(CONFIG.format(local_server.url))
+    with pytest.raises(SystemExit) as err:
+        fc.prepare_mods((2, 0, 10))
+    assert err.value.code == -60
+    assert os.listdir(str(tmp_path / 'cache')) == []
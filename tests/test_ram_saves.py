@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+
+import faas
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/factorio/saves/world.zip
+user = root
+
+[SERVICE]
+service-name = factorio-test.service
+ram-saves = yes
+ram-saves-sync-interval = 60
+"""
+
+
+@pytest.fixture
+def fc(make_commands, tmp_path, monkeypatch):
+    monkeypatch.setattr(faas, 'RUNTIME_PATH', str(tmp_path / 'run'))
+    saves = tmp_path / 'factorio' / 'saves'
+    saves.mkdir(parents=True)
+    (saves / 'world.zip').write_bytes(b'world on disk')
+    return make_commands(CONFIG, '--sync-saves')
+
+
+def test_unit_mounts_the_saves_in_memory(fc, tmp_path):
+    unit = fc.render_service()
+    config = str(tmp_path / 'config.ini')
+    sync = '+{0} {1} --sync-saves -C {2}'.format(sys.executable, os.path.abspath(faas.__file__), config)
+    assert 'Wants=factorio-test-saves-sync.timer\n' in unit
+    for line in ('RuntimeDirectory=factorio-test-saves', 'RuntimeDirectoryPreserve=yes',
+                 'BindPaths={0}:{1}'.format(tmp_path / 'run' / 'factorio-test-saves', tmp_path / 'factorio' / 'saves'),
+                 'ExecStartPre={0}'.format(sync), 'ExecStopPost={0}'.format(sync)):
+        assert line + '\n' in unit
+    timer = fc.render_saves_sync_timer()
+    assert 'PartOf=factorio-test.service\n' in timer and 'OnUnitActiveSec=60\n' in timer
+    assert 'Unit=factorio-test-saves-sync.service\n' in timer
+    assert 'ExecStart={0}\n'.format(sync[1:]) in fc.render_saves_sync_service()
+
+
+def test_save_must_be_in_its_own_directory(make_commands, tmp_path):
+    (tmp_path / 'factorio').mkdir()
+    (tmp_path / 'factorio' / 'world.zip').write_bytes(b'world')
+    fc = make_commands(CONFIG.replace('saves/world.zip', 'world.zip'), '--sync-saves')
+    with pytest.raises(SystemExit) as err:
+        fc.render_service()
+    assert err.value.code == -105
+
+
+def test_saves_round_trip(fc, tmp_path):
+    disk = tmp_path / 'factorio' / 'saves'
+    memory = tmp_path / 'run' / 'factorio-test-saves'
+    memory.mkdir(parents=True)
+    # ExecStartPre: the saves of the disk are copied to memory
+    fc.sync_saves()
+    assert (memory / 'world.zip').read_bytes() == b'world on disk'
+    assert fc._live_save_path() == str(memory / 'world.zip')
+
+    # The server saves and autosaves in memory
+    (memory / 'world.zip').write_bytes(b'world saved in memory')
+    (memory / '_autosave1.zip').write_bytes(b'autosave')
+    later = os.stat(str(disk / 'world.zip')).st_mtime + 10
+    os.utime(str(memory / 'world.zip'), (later, later))
+
+    # ExecStopPost (or the timer): back to the disk, with the mtime of the save
+    fc.sync_saves()
+    assert (disk / 'world.zip').read_bytes() == b'world saved in memory'
+    assert (disk / '_autosave1.zip').read_bytes() == b'autosave'
+    assert os.stat(str(disk / 'world.zip')).st_mtime == later
+    assert sorted(os.listdir(str(disk))) == ['_autosave1.zip', 'world.zip']
+
+    # Nothing changed: nothing is copied again
+    sync = faas.SaveSync(str(disk), str(memory), lambda *args: None)
+    assert sync.sync() == ([], [])
+
+
+def test_save_written_during_its_copy_is_synced_next_time(tmp_path, monkeypatch):
+    import shutil
+    disk, memory = tmp_path / 'disk', tmp_path / 'memory'
+    disk.mkdir()
+    memory.mkdir()
+    (memory / 'world.zip').write_bytes(b'partial')
+    copyfileobj = shutil.copyfileobj
+
+    def autosave_during_copy(src, dst, length):
+        copyfileobj(src, dst, length)
+        (memory / 'world.zip').write_bytes(b'complete save')
+    monkeypatch.setattr(shutil, 'copyfileobj', autosave_during_copy)
+    sync = faas.SaveSync(str(disk), str(memory), lambda *args: None)
+    assert sync.sync() == ([], [])
+    assert os.listdir(str(disk)) == []
+    monkeypatch.setattr(shutil, 'copyfileobj', copyfileobj)
+    assert sync.sync() == (['world.zip'], [])
+    assert (disk / 'world.zip').read_bytes() == b'complete save'
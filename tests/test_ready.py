@@ -0,0 +1,109 @@
+import os
+import socket
+import threading
+import time
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {{tmp}}/factorio
+save-path = {{tmp}}/save.zip
+
+[SERVICE]
+service-name = factorio-test.service
+wait-ready = {0}
+ready-log = {{tmp}}/factorio-current.log
+ready-port = {1}
+"""
+
+HOSTING = b'  12.345 Info ServerMultiplayerManager.cpp:800: Hosting game at IP ADDR:({0.0.0.0:34197})\n'
+
+
+def later(delay, action, *args):
+    thread = threading.Timer(delay, action, args)
+    thread.start()
+    return thread
+
+
+def append(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+
+
+def test_log_waits_for_a_new_hosting_line(make_commands, tmp_path):
+    log = str(tmp_path / 'factorio-current.log')
+    # The line of the previous run is not a sign that the new one is ready
+    append(log, HOSTING)
+    fc = make_commands(CONFIG.format('log', 34197))
+    position = fc._log_position()
+    assert not fc._wait_log(position, time.time() + 1)
+    # Written in two parts: a line is only matched once it is complete
+    later(0.2, append, log, HOSTING[:40])
+    later(0.8, append, log, HOSTING[40:])
+    start = time.time()
+    assert fc._wait_log(position, start + 5)
+    assert time.time() - start >= 0.8
+
+
+def test_log_replaced_by_the_new_server(make_commands, tmp_path):
+    log = str(tmp_path / 'factorio-current.log')
+    append(log, b'previous run\n' * 100)
+    fc = make_commands(CONFIG.format('log', 34197))
+    position = fc._log_position()
+
+    def replace():
+        append(log + '.new', HOSTING)
+        os.replace(log + '.new', log)
+    later(0.2, replace)
+    assert fc._wait_log(position, time.time() + 5)
+
+
+def test_log_missing_until_the_server_starts(make_commands, tmp_path):
+    fc = make_commands(CONFIG.format('log', 34197))
+    position = fc._log_position()
+    assert position == (None, 0)
+    later(0.2, append, str(tmp_path / 'factorio-current.log'), HOSTING)
+    assert fc._wait_log(position, time.time() + 5)
+
+
+def fake_journalctl(tmp_path, monkeypatch, output, delay=0):
+    """journalctl printing the given lines (after delay seconds) then following the journal forever"""
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    script = bin_path / 'journalctl'
+    script.write_text('#!/bin/sh\necho "$@" > {0}\nsleep {1}\nprintf "{2}"\nexec sleep 60\n'
+                      .format(tmp_path / 'journalctl.args', delay, output.replace('\n', '\\n')))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '{0}:{1}'.format(bin_path, os.environ['PATH']))
+
+
+def test_journal_ready(make_commands, tmp_path, monkeypatch):
+    fake_journalctl(tmp_path, monkeypatch, 'Loading map\n' + HOSTING.decode(), delay=0.3)
+    fc = make_commands(CONFIG.format('journal', 34197))
+    since = time.time()
+    assert fc._wait_journal(since, since + 5)
+    args = (tmp_path / 'journalctl.args').read_text().split()
+    assert args == ['-u', 'factorio-test.service', '-o', 'cat', '-f', '--since', '@{0}'.format(int(since))]
+
+
+def test_journal_not_ready_before_the_deadline(make_commands, tmp_path, monkeypatch):
+    fake_journalctl(tmp_path, monkeypatch, 'Loading map\n')
+    fc = make_commands(CONFIG.format('journal', 34197))
+    start = time.time()
+    assert not fc._wait_journal(start, start + 1)
+    assert time.time() - start < 3
+
+
+def test_port_bound_by_the_server(make_commands):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+    server.close()
+    fc = make_commands(CONFIG.format('port', port))
+    assert not fc._wait_port(time.time() + 0.6)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    later(0.3, server.bind, ('0.0.0.0', port))
+    try:
+        assert fc._wait_port(time.time() + 5)
+    finally:
+        server.close()
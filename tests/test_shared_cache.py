@@ -0,0 +1,53 @@
+import os
+
+import faas
+from conftest import write_archive
+
+SIZE = 200 * 1024
+
+
+def cache_size(cache):
+    return sum(os.path.getsize(os.path.join(path, name)) for root in (cache.archives_path, cache.objects_path)
+               for path, _, names in os.walk(root) for name in names)
+
+
+def add_version(tmp_path, cache, version):
+    files = {'bin/x64/factorio': version.encode(), 'data/{0}.dat'.format(version): os.urandom(SIZE)}
+    archive = write_archive(str(tmp_path / 'factorio-{0}.tar.xz'.format(version)), files)
+    cache.add_archive(version, archive, version.replace('.', '') * 8)
+    return files
+
+
+def test_installed_files_are_linked_to_the_store(tmp_path):
+    cache = faas.SharedCache(str(tmp_path / 'cache'), 1024 * 1024 * 1024, lambda *args: None)
+    files = add_version(tmp_path, cache, '1.0.0')
+    first, second = str(tmp_path / 'server1'), str(tmp_path / 'server2')
+    installer = cache.install('1.0.0', first)
+    assert installer.files_written == 2
+    cache.install('1.0.0', second)
+    for name, data in files.items():
+        with open(os.path.join(first, name), 'rb') as f:
+            assert f.read() == data
+        assert os.path.samefile(os.path.join(first, name), os.path.join(second, name))
+        assert os.stat(os.path.join(first, name)).st_nlink == 3
+    # Installing again only checks the links
+    installer = cache.install('1.0.0', first)
+    assert (installer.files_written, installer.files_skipped) == (0, 2)
+
+
+def test_cache_stays_within_its_size_limit(tmp_path):
+    max_size = int(3.5 * SIZE)
+    cache = faas.SharedCache(str(tmp_path / 'cache'), max_size, lambda *args: None)
+    server = str(tmp_path / 'server')
+    for version in ('1.0.0', '1.0.1', '1.0.2'):
+        files = add_version(tmp_path, cache, version)
+        assert cache_size(cache) <= max_size
+        cache.install(version, server)
+        assert cache_size(cache) <= max_size
+    # The least recently used archives were evicted, the installed version is intact
+    assert cache.get_archive('1.0.2') is not None
+    assert cache.get_archive('1.0.0') is None
+    for name, data in files.items():
+        with open(os.path.join(server, name), 'rb') as f:
+            assert f.read() == data
+    assert not os.path.exists(os.path.join(server, 'data', '1.0.1.dat'))
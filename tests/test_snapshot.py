@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import faas
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/save.zip
+
+[SNAPSHOT]
+path = {tmp}/snapshots
+"""
+
+
+def chunk_files(store):
+    return sorted(name for _, _, names in os.walk(store.chunks_path) for name in names)
+
+
+def autosave_during(store, monkeypatch, source, attempts):
+    """The save is rewritten while the first snapshots read it"""
+    iter_chunks = faas.SnapshotStore.iter_chunks
+    calls = []
+
+    def changing(f):
+        calls.append(f)
+        for index, data in enumerate(iter_chunks(f)):
+            if index == 1 and len(calls) <= attempts:
+                with open(source, 'ab') as save:
+                    save.write(os.urandom(1000))
+            yield data
+    monkeypatch.setattr(store, 'iter_chunks', changing)
+    return calls
+
+
+@pytest.fixture
+def save(tmp_path):
+    path = str(tmp_path / 'save.zip')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(3 * faas.SNAPSHOT_MAX_CHUNK))
+    return path
+
+
+def test_changed_save_leaves_no_orphaned_chunks(tmp_path, monkeypatch, save):
+    store = faas.SnapshotStore(str(tmp_path / 'snapshots'), vprint=lambda *args: None)
+    store.snapshot(save, 'default')
+    kept = chunk_files(store)
+    assert len(kept) == 3
+    with open(save, 'r+b') as f:
+        f.write(os.urandom(faas.SNAPSHOT_MAX_CHUNK))
+    autosave_during(store, monkeypatch, save, attempts=1)
+    with pytest.raises(faas.SaveChangedError):
+        store.snapshot(save, 'default')
+    assert chunk_files(store) == kept
+    assert len(store.manifests()) == 1
+
+
+def test_snapshot_retried_after_an_autosave(make_commands, monkeypatch, save):
+    monkeypatch.setattr(faas, 'SNAPSHOT_RETRY_DELAY', 0)
+    fc = make_commands(CONFIG)
+    store = fc._snapshot_store()
+    monkeypatch.setattr(fc, '_snapshot_store', lambda: store)
+    calls = autosave_during(store, monkeypatch, save, attempts=1)
+    fc.snapshot_save()
+    assert len(calls) == 2
+    [manifest] = store.manifests()
+    assert manifest['size'] == os.path.getsize(save)
+    restored = save + '.restored'
+    store.restore(manifest, restored)
+    with open(save, 'rb') as a, open(restored, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_snapshot_skipped_when_the_save_keeps_changing(make_commands, monkeypatch, capsys, save):
+    monkeypatch.setattr(faas, 'SNAPSHOT_RETRY_DELAY', 0)
+    fc = make_commands(CONFIG)
+    store = fc._snapshot_store()
+    monkeypatch.setattr(fc, '_snapshot_store', lambda: store)
+    calls = autosave_during(store, monkeypatch, save, attempts=faas.SNAPSHOT_RETRIES)
+    fc.snapshot_save()
+    assert len(calls) == faas.SNAPSHOT_RETRIES
+    assert 'Snapshot skipped' in capsys.readouterr().err
+    assert store.manifests() == [] and chunk_files(store) == []
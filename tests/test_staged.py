@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import faas
+from conftest import write_binary
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/factorio/saves/save.zip
+install-mode = staged
+"""
+
+
+def staged_commands(make_commands, tmp_path, ready):
+    factorio = tmp_path / 'factorio'
+    write_binary(str(factorio), '1.0.0')
+    (factorio / 'saves').mkdir()
+    (factorio / 'saves' / 'save.zip').write_bytes(b'save')
+    fc = make_commands(CONFIG)
+    fc.latest_version_data = faas.FactorioVersionPageParser.Version(faas.str_to_version('1.0.1'), '/get/1.0.1')
+    fc.download_extract_archive = lambda destination: write_binary(destination, '1.0.1')
+    fc.stop_server = lambda: None
+    fc.start_server = lambda: ready.pop(0)
+    return fc
+
+
+def test_first_staged_update_moves_the_existing_directory(make_commands, tmp_path):
+    fc = staged_commands(make_commands, tmp_path, [True])
+    fc._staged_update()
+    factorio = tmp_path / 'factorio'
+    assert os.path.islink(str(factorio))
+    assert os.path.realpath(str(factorio)) == str(tmp_path / 'factorio-1.0.1')
+    assert (tmp_path / 'factorio-1.0.0' / 'bin' / 'x64' / 'factorio').is_file()
+    assert (factorio / 'saves' / 'save.zip').read_bytes() == b'save'
+
+
+def test_rollback_of_the_first_staged_update(make_commands, tmp_path):
+    fc = staged_commands(make_commands, tmp_path, [False, True])
+    with pytest.raises(SystemExit) as exc:
+        fc._staged_update()
+    assert exc.value.code == -42
+    factorio = tmp_path / 'factorio'
+    assert os.path.islink(str(factorio))
+    assert os.path.realpath(str(factorio)) == str(tmp_path / 'factorio-1.0.0')
+    assert (factorio / 'bin' / 'x64' / 'factorio').is_file()
+    assert (factorio / 'saves' / 'save.zip').read_bytes() == b'save'
+
+
+def test_migration_to_another_filesystem_keeps_the_server_running(make_commands, tmp_path, monkeypatch):
+    import errno
+    fc = staged_commands(make_commands, tmp_path, [True])
+    stopped = []
+    fc.stop_server = lambda: stopped.append(True)
+    rename = os.rename
+
+    def cross_device_rename(source, destination):
+        if source == str(tmp_path / 'factorio'):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(source, destination)
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    with pytest.raises(SystemExit) as exc:
+        fc._staged_update()
+    assert exc.value.code == -43
+    assert not stopped
+    assert not os.path.islink(str(tmp_path / 'factorio'))
+    assert (tmp_path / 'factorio' / 'bin' / 'x64' / 'factorio').is_file()
+
+
+def test_save_written_at_the_stop_reaches_the_new_version(make_commands, tmp_path):
+    fc = staged_commands(make_commands, tmp_path, [True])
+    save = tmp_path / 'factorio-1.0.0' / 'saves' / 'save.zip'
+    fc.stop_server = lambda: save.write_bytes(b'saved at the stop')
+    fc._staged_update()
+    factorio = tmp_path / 'factorio'
+    assert os.path.realpath(str(factorio)) == str(tmp_path / 'factorio-1.0.1')
+    assert (factorio / 'saves' / 'save.zip').read_bytes() == b'saved at the stop'
+
+
+def test_rollback_keeps_the_latest_save(make_commands, tmp_path):
+    fc = staged_commands(make_commands, tmp_path, [True, True])
+    fc._staged_update()
+    save = tmp_path / 'factorio-1.0.1' / 'saves' / 'save.zip'
+    fc.stop_server = lambda: save.write_bytes(b'saved at the stop')
+    fc.rollback_server()
+    factorio = tmp_path / 'factorio'
+    assert os.path.realpath(str(factorio)) == str(tmp_path / 'factorio-1.0.0')
+    assert (factorio / 'saves' / 'save.zip').read_bytes() == b'saved at the stop'
+    assert not (factorio / faas.SHIPPED_FILE).exists()
+
+
+def test_directory_of_an_unknown_version_is_the_oldest_one(make_commands, tmp_path, capsys):
+    fc = staged_commands(make_commands, tmp_path, [True, True])
+    os.remove(str(tmp_path / 'factorio' / 'bin' / 'x64' / 'factorio'))
+    fc._staged_update()
+    previous = str(tmp_path / 'factorio-previous')
+    assert [path for _, path in fc._installed_versions()] == [str(tmp_path / 'factorio-1.0.1'), previous]
+    fc.rollback_server()
+    assert os.path.realpath(str(tmp_path / 'factorio')) == previous
+    assert 'rolled back to version previous' in capsys.readouterr().out
+
+    fc._swap_current(str(tmp_path / 'factorio-1.0.1'))
+    fc.config._keep_versions = 1
+    fc._prune_versions()
+    assert not os.path.exists(previous)
@@ -0,0 +1,11 @@
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize('case', range(4), ids=['-h', '-i', '-u', '-u experimental'])
+def test_fast_paths_do_not_load_the_heavy_modules(tmp_path, case):
+    """The import budget depends on the host: benchmark.py startup checks it, the modules loaded do not"""
+    _, args, _ = benchmark.startup_cases(str(tmp_path))[case]
+    _, _, modules = benchmark.measure_startup(args, repeat=1)
+    assert [name for name in benchmark.HEAVY_MODULES if name in modules] == []
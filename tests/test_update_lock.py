@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+import faas
+
+CONFIG = """
+[DEFAULT]
+factorio-path = {tmp}/factorio
+save-path = {tmp}/save.zip
+"""
+
+
+def test_concurrent_update_reuses_the_result(make_commands, tmp_path, monkeypatch):
+    monkeypatch.setattr(faas, 'LOCK_PATH', str(tmp_path))
+    holder, waiter = make_commands(CONFIG), make_commands(CONFIG)
+    started, release, updates = threading.Event(), threading.Event(), []
+
+    def slow_update():
+        updates.append(True)
+        started.set()
+        release.wait(5)
+        return True
+
+    holder._update_server = slow_update
+    waiter._update_server = lambda: updates.append(False)
+    waiting_started = threading.Event()
+    wait_update = waiter._wait_update
+
+    def wait(lock, start):
+        waiting_started.set()
+        return wait_update(lock, start)
+
+    waiter._wait_update = wait
+    thread = threading.Thread(target=holder.update_server)
+    thread.start()
+    started.wait(5)
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(waiter.update_server()))
+    waiting.start()
+    assert waiting_started.wait(5)
+    release.set()
+    thread.join(5)
+    waiting.join(5)
+    assert updates == [True]
+    assert results == [True]
+
+
+@pytest.fixture
+def shared_dir():
+    """Sticky directory writable by everyone, like /tmp or /run/lock"""
+    path = tempfile.mkdtemp(dir=faas.TMP_PATH)
+    os.chmod(path, 0o1777)
+    yield path
+    shutil.rmtree(path)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='needs to switch users')
+def test_lock_created_by_root_can_be_used_by_another_user(shared_dir):
+    import fcntl
+    path = os.path.join(shared_dir, 'faas.lock')
+    faas.open_shared_lock(path).close()
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    os.seteuid(65534)
+    try:
+        with faas.open_shared_lock(path) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with pytest.raises(OSError):
+                lock.write('result')
+                lock.flush()
+    finally:
+        os.seteuid(0)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='needs to switch users')
+def test_read_only_lock_of_another_user_can_still_be_locked(shared_dir):
+    import fcntl
+    path = os.path.join(shared_dir, 'faas.lock')
+    with open(path, 'w'):
+        pass
+    os.chmod(path, 0o644)
+    os.seteuid(65534)
+    try:
+        with faas.open_shared_lock(path) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+        os.seteuid(0)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='needs to switch users')
+def test_lock_directory_only_writable_by_root(make_commands, shared_dir, monkeypatch):
+    lock_dir = os.path.join(shared_dir, 'lock')
+    os.mkdir(lock_dir, 0o755)
+    monkeypatch.setattr(faas, 'LOCK_PATH', lock_dir)
+    fc = make_commands(CONFIG)
+    assert os.path.dirname(fc.config.update_lock_path) == lock_dir
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Another user, in a child process: the real uid is checked too
+        try:
+            os.setuid(65534)
+            os.write(write, os.path.dirname(fc.config.update_lock_path).encode())
+        finally:
+            os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    assert os.read(read, 4096).decode() == faas.TMP_PATH
+
+
+@pytest.mark.parametrize('content', ['', '[]', '{"result": "failed"}', '{"result": "done", "finished": 1e12}'])
+def test_invalid_result_of_another_run_is_ignored(make_commands, tmp_path, content):
+    fc = make_commands(CONFIG)
+    path = tmp_path / 'faas.lock'
+    path.write_text(content)
+    with open(str(path), 'r+') as lock:
+        assert fc._read_update_result(lock) is None
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='needs to switch users')
+def test_result_written_by_another_user_is_ignored(make_commands, tmp_path):
+    fc = make_commands(CONFIG)
+    path = tmp_path / 'faas.lock'
+    path.write_text('{"result": "failed", "code": -99, "version": null, "finished": 1e12}')
+    with open(str(path), 'r+') as lock:
+        assert fc._read_update_result(lock)['code'] == -99
+        os.chown(str(path), 65534, 65534)
+        assert fc._read_update_result(lock) is None